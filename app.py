@@ -1,20 +1,65 @@
+import time
+
+# Taken before the other imports, so that the startup breakdown includes importing TensorFlow
+_startup_start = time.monotonic()
+
+import atexit
 import logging
 import os
 import sys
 import traceback
-from flask import Flask, jsonify
+from flask import Flask, Response, g, jsonify, request
+from lib.admin_endpoint import profile_function, profile_status_function, reload_model_function
+from lib.batch_predict_endpoint import batch_predict_function
+from lib.inference_backend import configure_threads
+from lib.jobs import PredictionJobQueue
+from lib.jobs_endpoint import job_result_function, job_status_function, submit_job_function
+from lib.metrics import METRICS_ENABLED, register_state_collector, render_metrics, request_finished, request_started
 from lib.predict_endpoint import predict_function
+from lib.prediction import predict_scenes
+from lib.prediction_cache import PredictionCache
+from lib.profiling import RequestProfiler, instrumented
 from lib.setup import setup
+from lib.startup import StartupTimer
 from lib.local_predict_endpoint import local_predict_function
-import tensorflow as tf
-from tensorflow.keras.models import load_model
+from lib.model_registry import ModelRegistry
+from lib.tensor_cache import TensorCache
+from lib.time_series_endpoint import time_series_predict_function
 
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
+startup_timer = StartupTimer(_startup_start)
+startup_timer.lap("imports")
 
-MODEL_BASEPATH = "/model_files"
-SUPPORTED_MODELS = ["unified", "beznau"]
+MODEL_BASEPATH = os.getenv("MODEL_BASEPATH", "/model_files")
+# Comma-separated names of the models of the manifest this replica serves, all of them if unset
+MODELS = [name.strip().lower() for name in os.getenv("MODELS", "").split(",") if name.strip()]
+MODEL_LOADING = os.getenv("MODEL_LOADING", "eager")
+MODEL_IDLE_TIMEOUT = float(os.getenv("MODEL_IDLE_TIMEOUT", "0"))
+MODEL_WATCH_INTERVAL = float(os.getenv("MODEL_WATCH_INTERVAL", "0"))
+# Comma-separated batch sizes run through every model once loaded, e.g. the sizes the inference scheduler forms
+MODEL_WARMUP_BATCH_SIZES = [int(size) for size in os.getenv("MODEL_WARMUP_BATCH_SIZES", "1").split(",") if size.strip()]
+MODEL_ARTIFACT_DIR = os.getenv("MODEL_ARTIFACT_DIR")
+PREDICTION_CACHE_MAX_ENTRIES = int(os.getenv("PREDICTION_CACHE_MAX_ENTRIES", "10000"))
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", "3600"))
+PREDICTION_CACHE_DIR = os.getenv("PREDICTION_CACHE_DIR")
+TENSOR_CACHE_MAX_BYTES = int(os.getenv("TENSOR_CACHE_MAX_BYTES", str(512 * 1024**2)))
+TENSOR_CACHE_DIR = os.getenv("TENSOR_CACHE_DIR")
+INFERENCE_MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "32"))
+INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "5"))
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "keras")
+TFLITE_NUM_THREADS = int(os.getenv("TFLITE_NUM_THREADS", "0")) or None
+TF_INTRA_OP_THREADS = int(os.getenv("TF_INTRA_OP_THREADS", "0"))
+TF_INTER_OP_THREADS = int(os.getenv("TF_INTER_OP_THREADS", "0"))
+MODEL_VARIANT = os.getenv("MODEL_VARIANT", "float32")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "3600"))
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", "32"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Shared by the processes serving the API, e.g. the gunicorn workers, for them to share jobs and model reloads
+SHARED_STATE_DIR = os.getenv("SHARED_STATE_DIR")
 
 try: 
     KP_HOST = os.getenv("KP_HOST")
@@ -32,16 +77,118 @@ try:
         kp_port=KP_PORT,
         kp_scheme=KP_SCHEME,
     )
+    atexit.register(kernel_planckster_gateway.close)
+    atexit.register(file_repository.close)
 
 except Exception as e:
     logger.error(f"Error during setup: {str(e)}")
     sys.exit(1)
 
+startup_timer.lap("kernel_planckster")
 
 app = Flask(__name__)
-with tf.device("/CPU:0"):
-    unified_model = load_model(os.path.join(MODEL_BASEPATH, "Unified_model.keras"))
-    beznau_model = load_model(os.path.join(MODEL_BASEPATH, "Unified_Beznau_model.keras"))
+configure_threads(TF_INTRA_OP_THREADS, TF_INTER_OP_THREADS)
+model_registry = ModelRegistry(
+    base_path=MODEL_BASEPATH,
+    served=MODELS,
+    backend=INFERENCE_BACKEND,
+    num_threads=TFLITE_NUM_THREADS,
+    variant=MODEL_VARIANT,
+    max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+    max_wait_ms=INFERENCE_MAX_WAIT_MS,
+    idle_timeout=MODEL_IDLE_TIMEOUT,
+    watch_interval=MODEL_WATCH_INTERVAL,
+    warmup_batch_sizes=MODEL_WARMUP_BATCH_SIZES,
+    artifact_dir=MODEL_ARTIFACT_DIR,
+    reload_dir=os.path.join(SHARED_STATE_DIR, "reloads") if SHARED_STATE_DIR else None,
+)
+atexit.register(model_registry.close)
+
+# Lazy replicas load every model on its first request instead
+if MODEL_LOADING == "eager":
+    model_registry.warm()
+
+startup_timer.lap("models", {
+    f"{model['name']} {step}": seconds
+    for model in model_registry.status() if model['load_timings']
+    for step, seconds in model['load_timings'].items()
+})
+
+prediction_cache = PredictionCache(
+    max_entries=PREDICTION_CACHE_MAX_ENTRIES,
+    ttl=PREDICTION_CACHE_TTL,
+    disk_dir=PREDICTION_CACHE_DIR,
+) if PREDICTION_CACHE_MAX_ENTRIES > 0 else None
+
+tensor_cache = TensorCache(
+    max_bytes=TENSOR_CACHE_MAX_BYTES,
+    mmap_dir=TENSOR_CACHE_DIR,
+) if TENSOR_CACHE_MAX_BYTES > 0 else None
+
+job_queue = PredictionJobQueue(
+    run=lambda model_name, scenes: predict_scenes(
+        model_name,
+        model_registry.get(model_name),
+        scenes,
+        kernel_planckster_gateway,
+        file_repository,
+        prediction_cache,
+        tensor_cache,
+        # Jobs can be large backfills: bound the tensors held and the size of the forward passes
+        batch_size=JOB_BATCH_SIZE,
+    ),
+    workers=JOB_WORKERS,
+    max_queued=JOB_QUEUE_SIZE,
+    result_ttl=JOB_RESULT_TTL,
+    store_dir=os.path.join(SHARED_STATE_DIR, "jobs") if SHARED_STATE_DIR else None,
+)
+
+
+
+def cache_stats_by_cache():
+    return {
+        'prediction_cache': prediction_cache.stats() if prediction_cache else None,
+        'image_cache': file_repository.image_cache.stats() if file_repository.image_cache else None,
+        'signed_url_cache': kernel_planckster_gateway.signed_url_cache.stats() if kernel_planckster_gateway.signed_url_cache else None,
+        'tensor_cache': tensor_cache.stats() if tensor_cache else None,
+    }
+
+
+request_profiler = RequestProfiler(PROFILE_DIR)
+
+register_state_collector(
+    cache_stats=cache_stats_by_cache,
+    queue_depths=lambda: {
+        'jobs': job_queue.queue_depth,
+        **{f'inference_{name}': depth for name, depth in model_registry.queue_depths().items()},
+    },
+    kernel_planckster_stats=kernel_planckster_gateway.health.stats,
+)
+
+startup_timer.lap("caches_and_jobs")
+startup_timer.log()
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.request_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.response_status = 500
+    request_started(g.request_endpoint)
+
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(error):
+    # Popped, as the teardown runs a second time when a streamed response is closed, see stream_with_context
+    start = g.pop('request_start', None)
+    if start is not None:
+        request_finished(g.request_endpoint, g.response_status, time.perf_counter() - start)
 
 
 @app.route('/')
@@ -49,10 +196,67 @@ def home():
     return "Fast API running"
 
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Liveness: the worker answers requests
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # Readiness: the served models are loaded, or loaded on demand. Kernel Planckster is reported but not required:
+    # /local-predict and cached predictions don't need it, and an unready replica would never call it to notice it's back
+    models = model_registry.status()
+    ready = MODEL_LOADING != "eager" or all(model['loaded'] or MODEL_IDLE_TIMEOUT > 0 for model in models)
+
+    return jsonify({
+        'status': 'ready' if ready else 'not ready',
+        'models': models,
+        'kernel_planckster': kernel_planckster_gateway.health.state.value,
+        'job_queue_depth': job_queue.queue_depth,
+        'startup': startup_timer.timings(),
+    }), 200 if ready else 503
+
+
+@app.route('/models', methods=['GET'])
+def models():
+    return jsonify({'data': model_registry.status()})
+
+
+@app.route('/admin/models/<model_name>/reload', methods=['POST'])
+def reload_model(model_name: str):
+    return reload_model_function(model_registry, model_name)
+
+
+@app.route('/admin/profile', methods=['POST'])
+def profile():
+    return profile_function(request_profiler)
+
+
+@app.route('/admin/profile', methods=['GET'])
+def profile_status():
+    return profile_status_function(request_profiler)
+
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(cache_stats_by_cache())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify({'error': "Metrics are disabled, install 'prometheus_client' and set METRICS_ENABLED to enable them."}), 404
+
+    content, content_type = render_metrics()
+    return Response(content, content_type=content_type)
+
+
 @app.route('/local-predict', methods=['POST'])
+@instrumented(request_profiler, 'local-predict')
 def local_predict():
     try:
-        return local_predict_function(SUPPORTED_MODELS, unified_model, beznau_model)
+        return local_predict_function(model_registry)
 
     except Exception as e:
         print("Error during prediction: ", str(e))
@@ -60,9 +264,10 @@ def local_predict():
 
 
 @app.route('/predict', methods=['POST'])
+@instrumented(request_profiler, 'predict')
 def predict():
     try:
-        return predict_function(SUPPORTED_MODELS, unified_model, beznau_model, kernel_planckster_gateway, file_repository)
+        return predict_function(model_registry, kernel_planckster_gateway, file_repository, prediction_cache, tensor_cache)
 
     except Exception as e:
         print("Error during prediction: ", str(e))
@@ -73,6 +278,58 @@ def predict():
         }), 500
 
 
+@app.route('/batch-predict', methods=['POST'])
+def batch_predict():
+    try:
+        return batch_predict_function(model_registry, kernel_planckster_gateway, file_repository, prediction_cache, tensor_cache)
+
+    except Exception as e:
+        print("Error during batch prediction: ", str(e))
+        return jsonify({
+            'error': str(e),
+            'error_type': e.__class__.__name__,
+            'traceback': f"{traceback.format_exc()}",
+        }), 500
+
+
+@app.route('/predict-time-series', methods=['POST'])
+def predict_time_series():
+    try:
+        return time_series_predict_function(model_registry, kernel_planckster_gateway, file_repository, prediction_cache, tensor_cache)
+
+    except Exception as e:
+        print("Error during time series prediction: ", str(e))
+        return jsonify({
+            'error': str(e),
+            'error_type': e.__class__.__name__,
+            'traceback': f"{traceback.format_exc()}",
+        }), 500
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    try:
+        return submit_job_function(model_registry.names, job_queue)
+
+    except Exception as e:
+        print("Error during job submission: ", str(e))
+        return jsonify({
+            'error': str(e),
+            'error_type': e.__class__.__name__,
+            'traceback': f"{traceback.format_exc()}",
+        }), 500
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id: str):
+    return job_status_function(job_queue, job_id)
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id: str):
+    return job_result_function(job_queue, job_id)
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
 
@@ -0,0 +1,209 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+# The ASGI service shares the setup of the Flask one: configuration, Kernel Planckster gateway, models and caches
+from app import (
+    INFERENCE_MAX_BATCH_SIZE,
+    file_repository,
+    kernel_planckster_gateway,
+    model_registry,
+    prediction_cache,
+    tensor_cache,
+)
+from lib.local_predict_endpoint import parse_local_predict_request
+from lib.metrics import METRICS_ENABLED, render_metrics, request_finished, request_started, stage_timer
+from lib.predict_endpoint import parse_predict_request
+from lib.prediction import InvalidRequestError, load_scene_async, preprocess_images
+from lib.setup import setup_async
+from lib.utils import predictions_to_records
+
+
+logger = logging.getLogger(__name__)
+
+# Threads decoding images, and threads waiting on the inference schedulers: enough of the latter lets the schedulers
+# fill their batches, while requests waiting on the network hold no thread at all
+ASGI_DECODE_WORKERS = int(os.getenv("ASGI_DECODE_WORKERS", str(os.cpu_count() or 4)))
+ASGI_INFERENCE_WORKERS = int(os.getenv("ASGI_INFERENCE_WORKERS", str(INFERENCE_MAX_BATCH_SIZE)))
+
+async_kernel_planckster_gateway, async_file_repository = setup_async(logger, kernel_planckster_gateway, file_repository)
+decode_executor = ThreadPoolExecutor(max_workers=ASGI_DECODE_WORKERS, thread_name_prefix="asgi-decode")
+inference_executor = ThreadPoolExecutor(max_workers=ASGI_INFERENCE_WORKERS, thread_name_prefix="asgi-inference")
+
+
+async def read_json(request: Request):
+    """
+    The JSON payload of the request, or None if the body isn't valid JSON, for the endpoint to answer `400` as for any
+    other invalid payload.
+    """
+    try:
+        return await request.json()
+    except ValueError:  # json.JSONDecodeError, or a body that isn't UTF-8
+        return None
+
+
+async def home(request: Request) -> PlainTextResponse:
+    return PlainTextResponse("ASGI API running")
+
+
+async def healthz(request: Request) -> JSONResponse:
+    return JSONResponse({'status': 'ok', 'pid': os.getpid()})
+
+
+async def metrics(request: Request) -> Response:
+    if not METRICS_ENABLED:
+        return JSONResponse({'error': "Metrics are disabled, install 'prometheus_client' and set METRICS_ENABLED to enable them."}, status_code=404)
+
+    content, content_type = render_metrics()
+    return Response(content, media_type=content_type)
+
+
+async def local_predict(request: Request) -> JSONResponse:
+    try:
+        data = await read_json(request)
+        print("Received request:", data)
+
+        try:
+            model_name, images = parse_local_predict_request(data, model_registry.names)
+        except InvalidRequestError as e:
+            return JSONResponse(e.to_dict(), status_code=400)
+
+        loop = asyncio.get_running_loop()
+        combined_images = await loop.run_in_executor(decode_executor, preprocess_images, images)
+
+        model = model_registry.get(model_name)
+        predictions, model_version = await loop.run_in_executor(
+            inference_executor, model.predict_with_version, np.expand_dims(combined_images, axis=0),  # Add batch dimension
+        )
+
+        with stage_timer("serialize"):
+            return JSONResponse({
+                'data': predictions_to_records(model_name, predictions, model.labels)[0],
+                'model_version': model_version,
+            })
+
+    except Exception as e:
+        print("Error during prediction: ", str(e))
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def predict(request: Request) -> JSONResponse:
+    try:
+        data = await read_json(request)
+        print("Received request:", data)
+
+        try:
+            model_name, parsed_relative_paths = parse_predict_request(data, model_registry.names)
+        except InvalidRequestError as e:
+            return JSONResponse(e.to_dict(), status_code=400)
+
+        model = model_registry.get(model_name)
+
+        try:
+            # The version hashes the model file if it isn't loaded, and the prediction cache may read from disk
+            if prediction_cache:
+                model_version = await asyncio.to_thread(lambda: model.version)
+                cached_records = await asyncio.to_thread(prediction_cache.get, model_name, parsed_relative_paths, model_version)
+                if cached_records is not None:
+                    return JSONResponse({
+                        'data': cached_records,
+                        'model_version': model_version,
+                    })
+
+            # Download the images from Kernel Planckster on the event loop, decode them on the decode threads
+            combined_images = await load_scene_async(
+                parsed_relative_paths, async_kernel_planckster_gateway, async_file_repository, decode_executor, tensor_cache,
+            )
+
+            predictions, model_version = await asyncio.get_running_loop().run_in_executor(
+                inference_executor, model.predict_with_version, np.expand_dims(combined_images, axis=0),  # Add batch dimension
+            )
+            with stage_timer("serialize"):
+                records = predictions_to_records(model_name, predictions, model.labels)[0]
+                response = JSONResponse({
+                    'data': records,
+                    'model_version': model_version,
+                })
+
+            if prediction_cache:
+                await asyncio.to_thread(prediction_cache.put, model_name, parsed_relative_paths, records, model_version)
+
+            return response
+
+        except Exception as e:
+            return JSONResponse({
+                "error": f"Failed to make prediction for model '{model_name}'.",
+                "details": str(e),
+                "error_type": e.__class__.__name__,
+                "traceback": traceback.format_exc(),
+            }, status_code=500)
+
+    except Exception as e:
+        print("Error during prediction: ", str(e))
+        return JSONResponse({
+            'error': str(e),
+            'error_type': e.__class__.__name__,
+            'traceback': f"{traceback.format_exc()}",
+        }, status_code=500)
+
+
+class RequestMetricsMiddleware:
+    """
+    Counts the requests being answered and their outcome, see app.py's request hooks.
+    """
+
+    def __init__(self, app) -> None:
+        self._app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+
+        endpoint = scope["path"] if scope["path"] in ROUTE_PATHS else "unmatched"
+        status = 500
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        request_started(endpoint)
+        try:
+            await self._app(scope, receive, send_with_status)
+        finally:
+            request_finished(endpoint, status, time.perf_counter() - start)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    yield
+    await async_kernel_planckster_gateway.aclose()
+    await async_file_repository.aclose()
+    decode_executor.shutdown(wait=False)
+    inference_executor.shutdown(wait=False)
+
+
+routes = [
+    Route('/', home),
+    Route('/healthz', healthz, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET']),
+    Route('/local-predict', local_predict, methods=['POST']),
+    Route('/predict', predict, methods=['POST']),
+]
+ROUTE_PATHS = {route.path for route in routes}
+
+app = Starlette(routes=routes, middleware=[Middleware(RequestMetricsMiddleware)], lifespan=lifespan)
@@ -0,0 +1,81 @@
+import asyncio
+import sys
+
+import httpx
+
+sys.path.append("../..")
+
+from lib.sdk.health import CircuitState
+from lib.sdk.kernel_plackster_gateway import AsyncKernelPlancksterGateway, KernelPlancksterGateway
+from lib.sdk.models import KernelPlancksterSourceData, ProtocolEnum
+
+
+SOURCE_DATA = KernelPlancksterSourceData(name="image", protocol=ProtocolEnum.S3, relative_path="case/tracer/1/image.png")
+
+
+def _half_open_gateway() -> KernelPlancksterGateway:
+    """
+    A gateway whose circuit opens after a single failure and lets a trial call through right away.
+    """
+    gateway = KernelPlancksterGateway(
+        host="kp", port="80", auth_token="token", scheme="http", failure_threshold=1, recovery_timeout=0, signed_url_cache=None,
+    )
+    gateway.health.record_failure()
+    assert gateway.health.state == CircuitState.OPEN
+    return gateway
+
+
+def _signed_url_response(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, json={"signed_url": "http://storage/image.png"})
+
+
+def check_failing_trial() -> None:
+    """
+    A trial call raising something else than a transport error must not leave the circuit stuck half open.
+    """
+    gateway = _half_open_gateway()
+
+    def broken(request: httpx.Request) -> httpx.Response:
+        raise RuntimeError("not a transport error")
+
+    gateway._client = httpx.Client(transport=httpx.MockTransport(broken))
+    try:
+        gateway.generate_signed_url_for_download(SOURCE_DATA)
+    except RuntimeError:
+        pass
+
+    gateway._client = httpx.Client(transport=httpx.MockTransport(_signed_url_response))
+    gateway.generate_signed_url_for_download(SOURCE_DATA)
+    assert gateway.health.state == CircuitState.CLOSED, gateway.health.state
+    print("sync gateway, failing trial call: OK")
+
+
+def check_cancelled_trial() -> None:
+    """
+    A trial call cancelled by a timeout must not leave the circuit stuck half open.
+    """
+    gateway = _half_open_gateway()
+    async_gateway = AsyncKernelPlancksterGateway(gateway)
+
+    async def hanging(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(60)
+        return _signed_url_response(request)
+
+    async def run() -> None:
+        async_gateway._client = httpx.AsyncClient(transport=httpx.MockTransport(hanging))
+        try:
+            await asyncio.wait_for(async_gateway.generate_signed_url_for_download(SOURCE_DATA), timeout=0.1)
+        except asyncio.TimeoutError:
+            pass
+
+        async_gateway._client = httpx.AsyncClient(transport=httpx.MockTransport(_signed_url_response))
+        await async_gateway.generate_signed_url_for_download(SOURCE_DATA)
+
+    asyncio.run(run())
+    assert gateway.health.state == CircuitState.CLOSED, gateway.health.state
+    print("async gateway, cancelled trial call: OK")
+
+
+if __name__ == "__main__":
+    check_failing_trial()
+    check_cancelled_trial()
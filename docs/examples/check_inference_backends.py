@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+
+sys.path.append("../..")
+
+import numpy as np
+
+from lib.inference_backend import INFERENCE_BACKENDS, load_backend
+from lib.model_registry import ModelSpec, load_manifest
+from lib.quantization import load_scene_directory
+from lib.utils import predictions_to_records
+
+
+def load_samples(img_dir: str, random_samples: int) -> np.ndarray:
+    """
+    Load every scene of `img_dir`, plus random inputs to cover more of the input space than the test images do.
+    """
+
+    samples = load_scene_directory(img_dir)
+
+    if random_samples:
+        rng = np.random.default_rng(0)
+        samples = np.concatenate([samples, rng.random((random_samples, *samples.shape[1:]), dtype=np.float32)])
+
+    return samples
+
+
+def check(spec: ModelSpec, model_file: str, samples: np.ndarray, backends, tolerance: float) -> bool:
+    model_name = spec.name
+    reference = predictions_to_records(model_name, load_backend(model_file, "keras").predict(samples), spec.labels)
+    ok = True
+
+    for backend in backends:
+        records = predictions_to_records(model_name, load_backend(model_file, backend).predict(samples), spec.labels)
+
+        mismatches = sum(
+            ref["prediction"] != rec["prediction"]
+            for ref_sample, sample in zip(reference, records)
+            for ref, rec in zip(ref_sample, sample)
+        )
+        drift = max(
+            abs(ref["confidence"] - rec["confidence"])
+            for ref_sample, sample in zip(reference, records)
+            for ref, rec in zip(ref_sample, sample)
+        )
+
+        passed = mismatches == 0 and drift <= tolerance
+        ok = ok and passed
+        print(f"{model_name:8} {backend:12} ON/OFF mismatches: {mismatches:3}  max confidence drift: {drift:.2e}  {'OK' if passed else 'FAILED'}")
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that every inference backend predicts the same as Keras.")
+    parser.add_argument("--model-dir", default="/model_files")
+    parser.add_argument("--img-dir", default="test_img")
+    parser.add_argument("--random-samples", type=int, default=16)
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="maximum confidence difference")
+    parser.add_argument("--backends", nargs="+", default=[b for b in INFERENCE_BACKENDS if b != "keras"])
+    args = parser.parse_args()
+
+    samples = load_samples(args.img_dir, args.random_samples)
+    print(f"Checking {len(samples)} samples against the keras backend\n")
+
+    ok = all([
+        check(spec, os.path.join(args.model_dir, spec.file), samples, args.backends, args.tolerance)
+        for spec in load_manifest(args.model_dir)
+    ])
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
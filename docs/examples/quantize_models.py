@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import sys
+
+sys.path.append("../..")
+
+from tensorflow.keras.models import load_model
+
+from lib.inference_backend import TFLiteBackend
+from lib.model_registry import load_manifest
+from lib.quantization import QUANTIZATION_MODES, accuracy_report, load_scene_directory, quantize_model, quantized_model_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write quantized variants of the models and report their accuracy against the float models.")
+    parser.add_argument("--model-dir", default="/model_files")
+    parser.add_argument("--calibration-dir", default="test_img", help="scenes used to calibrate int8 activations")
+    parser.add_argument("--eval-dir", required=True, help="scenes used for the accuracy report, held out from the calibration scenes")
+    parser.add_argument("--modes", nargs="+", default=QUANTIZATION_MODES, choices=QUANTIZATION_MODES)
+    parser.add_argument("--min-agreement", type=float, default=1.0, help="minimum share of samples with the same ON/OFF")
+    parser.add_argument("--max-drift", type=float, default=0.05, help="maximum confidence drift")
+    parser.add_argument("--report", default="quantization_report.json")
+    args = parser.parse_args()
+
+    # The int8 ranges fit the calibration scenes, evaluating on them would overstate the accuracy
+    if os.path.realpath(args.eval_dir) == os.path.realpath(args.calibration_dir):
+        parser.error("--eval-dir must hold other scenes than --calibration-dir, the accuracy report would be in-sample")
+
+    calibration_samples = load_scene_directory(args.calibration_dir)
+    eval_samples = load_scene_directory(args.eval_dir)
+    print(f"Calibrating on {len(calibration_samples)} scenes, evaluating on {len(eval_samples)} scenes\n")
+
+    report = {}
+    ok = True
+
+    for spec in load_manifest(args.model_dir):
+        model_name = spec.name
+        model_path = os.path.join(args.model_dir, spec.file)
+        model = load_model(model_path)
+        reference_predictions = model.predict(eval_samples, batch_size=len(eval_samples), verbose=0)
+
+        for mode in args.modes:
+            content = quantize_model(model, mode, calibration_samples)
+            output_path = quantized_model_file(model_path, mode)
+            with open(output_path, "wb") as f:
+                f.write(content)
+
+            towers = accuracy_report(model_name, reference_predictions, TFLiteBackend(content).predict(eval_samples), spec.labels)
+            report.setdefault(model_name, {})[mode] = {
+                "file": output_path,
+                "bytes": len(content),
+                "float_bytes": os.path.getsize(model_path),
+                "towers": towers,
+            }
+
+            for label, tower in towers.items():
+                passed = tower["agreement"] >= args.min_agreement and tower["max_confidence_drift"] <= args.max_drift
+                ok = ok and passed
+                print(
+                    f"{label:16} {mode:8} {len(content) / 1024**2:8.1f} MiB  ON/OFF agreement: {tower['agreement']:.2%}  "
+                    f"confidence drift: mean {tower['mean_confidence_drift']:.2e}, max {tower['max_confidence_drift']:.2e}  "
+                    f"{'OK' if passed else 'FAILED'}"
+                )
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {args.report}")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
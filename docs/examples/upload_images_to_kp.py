@@ -3,6 +3,7 @@ import sys
 sys.path.append("../..")
 
 from lib.predict_endpoint import IMAGE_SEQUENCE
+from lib.sdk.bulk_upload import BulkUploader, BulkUploadItem
 from lib.sdk.file_repository import FileRepository
 from lib.sdk.kernel_plackster_gateway import KernelPlancksterGateway
 from lib.sdk.models import KernelPlancksterRelativePath, KernelPlancksterSourceData, ProtocolEnum
@@ -55,26 +56,28 @@ def main():
         ]
 
         print("\n\n\t=> Uploading images to Kernel Planckster...\n")
-        for sd, local_path in zip(source_data, img_local_paths):
 
-            print(f"Uploading {local_path} to Kernel Planckster.")
-            print(f"Relative path will be: {sd.relative_path}\n")
+        uploader = BulkUploader(
+            kernel_planckster_gateway=kernel_planckster_gateway,
+            file_repository=file_repository,
+            max_workers=8,
+            journal_path="upload_images_to_kp.journal",
+        )
 
+        report = uploader.upload(
+            items=[
+                BulkUploadItem(local_path=local_path, source_data=sd)
+                for sd, local_path in zip(source_data, img_local_paths)
+            ],
+            progress=lambda p: print(f"{p.done}/{p.total} done ({p.uploaded} uploaded, {p.skipped} skipped, {p.failed} failed)"),
+        )
 
-            signed_url = kernel_planckster_gateway.generate_signed_url_for_upload(
-                source_data = sd
-            )
-            file_repository.public_upload(
-                signed_url=signed_url,
-                file_path=local_path
-            )
-            res = kernel_planckster_gateway.register_new_source_data(
-                source_data=sd
-            )
+        for failure in report.failed:
+            print(f"Failed to upload {failure.relative_path} after {failure.attempts} attempts: {failure.error}")
+
+        if report.failed:
+            raise Exception(f"{len(report.failed)} images failed to upload, run again to retry them.")
 
-            print(res)
-            print()
-        
         print(f"Images uploaded successfully to Kernel Planckster!")
         print(f"Relative paths:\n{"\n".join([sd.relative_path for sd in source_data])}\n")
 
@@ -0,0 +1,46 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# Import TensorFlow once in the master, so that the workers share its libraries copy-on-write. The models themselves
+# are loaded by every worker after the fork: TensorFlow's runtime threads don't survive a fork.
+import tensorflow  # noqa: F401
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("SERVING_WORKERS", "2"))
+# Threads let concurrent requests of a worker share forward passes through its inference schedulers
+worker_class = "gthread"
+threads = int(os.getenv("SERVING_THREADS", "8"))
+timeout = int(os.getenv("SERVING_TIMEOUT", "300"))
+graceful_timeout = 30
+accesslog = "-"
+
+# Split the cores between the workers rather than letting each use all of them, unless set explicitly
+_cores_per_worker = str(max(1, multiprocessing.cpu_count() // workers))
+os.environ.setdefault("TF_INTRA_OP_THREADS", _cores_per_worker)
+os.environ.setdefault("TF_INTER_OP_THREADS", "1")
+os.environ.setdefault("TFLITE_NUM_THREADS", _cores_per_worker)
+
+# Created once in the master, so that every worker, including the ones restarted later, shares jobs and model reloads
+if not os.getenv("SHARED_STATE_DIR"):
+    os.environ["SHARED_STATE_DIR"] = tempfile.mkdtemp(prefix="predictor-state-")
+
+
+def on_starting(server):
+    # The metrics of workers from a previous run must not be aggregated with those of this one
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir)
+
+
+def child_exit(server, worker):
+    # Drop the in-flight gauges of a dead worker from the metrics aggregated across workers
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        try:
+            from prometheus_client import multiprocess
+        except ImportError:
+            return
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,90 @@
+import hmac
+import os
+import traceback
+from flask import request, jsonify
+from lib.model_registry import ModelRegistry
+from lib.profiling import PROFILE_MODES, RequestProfiler
+
+
+# Admin endpoints are disabled unless a token is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def admin_error():
+    """
+    The error response for a request that doesn't carry the admin token as an `Authorization: Bearer` header, or
+    None if it does.
+    """
+
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled, set ADMIN_TOKEN to enable them.'}), 404
+
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {ADMIN_TOKEN}"):
+        return jsonify({'error': 'Invalid or missing admin token.'}), 403
+
+    return None
+
+
+def reload_model_function(model_registry: ModelRegistry, model_name: str):
+
+    error = admin_error()
+    if error:
+        return error
+
+    SUPPORTED_MODELS = model_registry.names
+    original_model_name = model_name
+    model_name = original_model_name.strip().lower()
+    if model_name not in SUPPORTED_MODELS:
+        return jsonify({"error": f"Invalid model name '{original_model_name}'. Please choose from {SUPPORTED_MODELS}"}), 404
+
+    model = model_registry.get(model_name)
+
+    try:
+        model_version = model_registry.reload(model_name)
+
+    except Exception as e:
+        return jsonify({
+            "error": f"Failed to reload model '{model_name}', still serving version {model.status()['version']}.",
+            "details": str(e),
+            "error_type": e.__class__.__name__,
+            "traceback": traceback.format_exc(),
+        }), 500
+
+    return jsonify({
+        'model_name': model_name,
+        'model_version': model_version,
+    })
+
+
+def profile_function(request_profiler: RequestProfiler):
+
+    error = admin_error()
+    if error:
+        return error
+
+    data = request.get_json(silent=True) or {}
+
+    requests = data.get('requests', 1)
+    if not isinstance(requests, int) or requests < 1:
+        return jsonify({'error': f"Invalid number of requests '{requests}', it must be a positive integer."}), 400
+
+    mode = data.get('mode', PROFILE_MODES[0])
+    if mode not in PROFILE_MODES:
+        return jsonify({"error": f"Invalid profile mode '{mode}'. Please choose from {PROFILE_MODES}"}), 400
+
+    try:
+        request_profiler.arm(requests, mode)
+    except ValueError as e:
+        # A capture is in progress
+        return jsonify({'error': str(e), **request_profiler.status()}), 409
+
+    return jsonify(request_profiler.status())
+
+
+def profile_status_function(request_profiler: RequestProfiler):
+
+    error = admin_error()
+    if error:
+        return error
+
+    return jsonify(request_profiler.status())
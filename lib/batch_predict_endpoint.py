@@ -0,0 +1,77 @@
+import os
+import traceback
+from typing import Optional
+from flask import request, jsonify
+from lib.ndjson import ndjson_response, wants_ndjson
+from lib.prediction import iter_scene_predictions, predict_scenes
+from lib.model_registry import ModelRegistry
+from lib.prediction_cache import PredictionCache
+from lib.sdk.file_repository import FileRepository
+from lib.sdk.kernel_plackster_gateway import KernelPlancksterGateway
+from lib.tensor_cache import TensorCache
+
+
+BATCH_PREDICT_MAX_SCENES = int(os.getenv("BATCH_PREDICT_MAX_SCENES", "512"))
+# Streamed responses run scenes through the model in batches of this size, instead of all at once
+BATCH_PREDICT_STREAM_BATCH_SIZE = int(os.getenv("BATCH_PREDICT_STREAM_BATCH_SIZE", "32"))
+
+
+def batch_predict_function(
+    model_registry: ModelRegistry,
+    kernel_planckster_gateway: KernelPlancksterGateway,
+    file_repository: FileRepository,
+    prediction_cache: Optional[PredictionCache] = None,
+    tensor_cache: Optional[TensorCache] = None,
+    ):
+
+    data = request.json  # Expect JSON payload
+
+    # Validate inputs
+    required_keys = ['scenes', 'model_name']
+    if not data or not all(key in data for key in required_keys):
+        return jsonify({'error': f'Invalid input. JSON with keys {required_keys} is required.'}), 400
+
+    scenes = data['scenes']
+    if not isinstance(scenes, list) or not all(isinstance(scene, list) for scene in scenes):
+        return jsonify({'error': 'Invalid input. "scenes" must be a list of lists of relative paths.'}), 400
+
+    # Log the incoming request; the full payload can hold thousands of paths
+    print(f"Received batch request: {len(scenes)} scenes for model '{data['model_name']}'")
+
+    if not 0 < len(scenes) <= BATCH_PREDICT_MAX_SCENES:
+        return jsonify({"error": f"Between 1 and {BATCH_PREDICT_MAX_SCENES} scenes required, Received {len(scenes)}."}), 400
+
+    SUPPORTED_MODELS = model_registry.names
+    original_model_name = data['model_name']
+    model_name = original_model_name.strip().lower()
+    if model_name not in SUPPORTED_MODELS:
+        return jsonify({"error": f"Invalid model name '{original_model_name}'. Please choose from {SUPPORTED_MODELS}"}), 400
+
+    model = model_registry.get(model_name)
+
+    if wants_ndjson():
+        return ndjson_response(iter_scene_predictions(
+            model_name,
+            model,
+            scenes,
+            kernel_planckster_gateway,
+            file_repository,
+            prediction_cache,
+            tensor_cache,
+            batch_size=BATCH_PREDICT_STREAM_BATCH_SIZE,
+        ))
+
+    try:
+        results = predict_scenes(model_name, model, scenes, kernel_planckster_gateway, file_repository, prediction_cache, tensor_cache)
+
+        return jsonify({
+            'data': results
+        })
+
+    except Exception as e:
+        return jsonify({
+            "error": f"Failed to make batch prediction for model '{model_name}'.",
+            "details": str(e),
+            "error_type": e.__class__.__name__,
+            "traceback": traceback.format_exc(),
+        }), 500
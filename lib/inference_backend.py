@@ -0,0 +1,280 @@
+import logging
+import os
+import re
+import shutil
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.export import ExportArchive
+from tensorflow.keras.models import load_model
+
+
+INFERENCE_BACKENDS = ["keras", "tf_function", "tflite"]
+
+
+class InferenceBackend:
+    """
+    Runs a model's forward pass. `predict` returns the same as `keras.Model.predict`: an array of shape
+    (batch, ...) for models with a single output, or a list of arrays for models with one output per tower.
+    """
+
+    name: str
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger(__name__)
+
+    @property
+    def input_shape(self) -> Tuple[int, ...]:
+        """
+        The shape of a single sample, without the batch dimension.
+        """
+        raise NotImplementedError
+
+    def predict(self, x: np.ndarray, batch_size: Optional[int] = None, verbose: int = 0) -> Any:
+        raise NotImplementedError
+
+
+class KerasBackend(InferenceBackend):
+    """
+    The eager `Model.predict` path, kept as the reference for parity checks.
+    """
+
+    name = "keras"
+
+    def __init__(self, model) -> None:
+        self._model = model
+
+    @property
+    def input_shape(self) -> Tuple[int, ...]:
+        return tuple(self._model.input_shape[1:])
+
+    def predict(self, x: np.ndarray, batch_size: Optional[int] = None, verbose: int = 0) -> Any:
+        return self._model.predict(x, batch_size=batch_size or len(x), verbose=verbose)
+
+
+class TFFunctionBackend(InferenceBackend):
+    """
+    Calls the model through a `tf.function` traced once for a fixed input signature with a variable batch size,
+    skipping the data adapter and callbacks `Model.predict` builds on every call.
+    """
+
+    name = "tf_function"
+
+    def __init__(self, model=None, saved_model_path: Optional[str] = None) -> None:
+        """
+        :param model: the Keras model to trace
+        :param saved_model_path: a directory written by `save`, restored without loading nor tracing the Keras model
+        """
+        if saved_model_path:
+            self._model = tf.saved_model.load(saved_model_path)
+            self._forward = self._model.forward
+            self._multi_output = len(self._forward.concrete_functions[0].structured_outputs) > 1
+        else:
+            self._model = model
+            self._multi_output = len(model.outputs) > 1
+
+            @tf.function(input_signature=[tf.TensorSpec([None, *model.input_shape[1:]], tf.float32)])
+            def forward(x):
+                return _named_outputs(model(x, training=False))
+
+            self._forward = forward
+
+        self._input_shape = tuple(self._forward.input_signature[0].shape[1:])
+
+    @property
+    def input_shape(self) -> Tuple[int, ...]:
+        return self._input_shape
+
+    def predict(self, x: np.ndarray, batch_size: Optional[int] = None, verbose: int = 0) -> Any:
+        outputs = self._forward(tf.convert_to_tensor(x, dtype=tf.float32))
+        return _unname_outputs({name: tensor.numpy() for name, tensor in outputs.items()}, self._multi_output)
+
+    def save(self, path: str) -> None:
+        """
+        Export the traced function and the weights as a SavedModel directory.
+        """
+        archive = ExportArchive()
+        archive.track(self._model)
+        archive.add_endpoint("forward", self._forward)
+        archive.write_out(path, verbose=False)
+
+
+class TFLiteBackend(InferenceBackend):
+    """
+    Runs a TFLite flatbuffer, either converted from the Keras model at startup or read from a `.tflite` file.
+
+    The interpreter isn't thread safe, so calls are serialised; the inference scheduler already runs one batch at a
+    time per model.
+    """
+
+    name = "tflite"
+
+    def __init__(self, model_content: Optional[bytes] = None, num_threads: Optional[int] = None, model_path: Optional[str] = None) -> None:
+        """
+        :param model_content: the flatbuffer, for a model converted in memory
+        :param model_path: the `.tflite` file, which is memory-mapped rather than read, so that the weights are shared
+            through the page cache by every worker process serving it
+        """
+        self._interpreter = tf.lite.Interpreter(model_content=model_content, model_path=model_path, num_threads=num_threads)
+        self._runner = self._interpreter.get_signature_runner()
+        self._input_name, input_details = next(iter(self._runner.get_input_details().items()))
+        self._input_shape = tuple(int(dim) for dim in input_details["shape_signature"][1:])
+        self._multi_output = len(self._runner.get_output_details()) > 1
+        self._lock = threading.Lock()
+
+    @property
+    def input_shape(self) -> Tuple[int, ...]:
+        return self._input_shape
+
+    @classmethod
+    def from_keras(cls, model, num_threads: Optional[int] = None) -> "TFLiteBackend":
+        return cls(convert_to_tflite(model), num_threads)
+
+    def predict(self, x: np.ndarray, batch_size: Optional[int] = None, verbose: int = 0) -> Any:
+        with self._lock:
+            outputs = self._runner(**{self._input_name: np.asarray(x, dtype=np.float32)})
+        return _unname_outputs(outputs, self._multi_output)
+
+
+def convert_to_tflite(model, optimizations=None, representative_dataset=None, supported_types=None) -> bytes:
+    """
+    Convert a Keras model to a TFLite flatbuffer, with a variable batch size.
+
+    :param optimizations: `tf.lite.Optimize` flags, e.g. to quantize the model
+    :param representative_dataset: calibration samples for int8 quantization
+    :param supported_types: e.g. `[tf.float16]` for float16 quantization
+    """
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if optimizations:
+        converter.optimizations = optimizations
+    if representative_dataset:
+        converter.representative_dataset = representative_dataset
+    if supported_types:
+        converter.target_spec.supported_types = supported_types
+
+    return converter.convert()
+
+
+def configure_threads(intra_op_threads: int = 0, inter_op_threads: int = 0) -> None:
+    """
+    Set the size of TensorFlow's thread pools, so that worker processes sharing a machine don't oversubscribe its
+    cores. Must be called before TensorFlow runs anything; `0` leaves TensorFlow's default of one thread per core.
+
+    :param intra_op_threads: threads used to parallelise a single op, e.g. a convolution
+    :param inter_op_threads: threads used to run independent ops concurrently
+    """
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def load_backend(
+    model_file: str,
+    backend: str = "keras",
+    num_threads: Optional[int] = None,
+    artifact_dir: Optional[str] = None,
+    version: Optional[str] = None,
+) -> InferenceBackend:
+    """
+    Load a model file with the given inference backend.
+
+    :param model_file: a `.keras` file, or a `.tflite` file for the tflite backend
+    :param backend: one of INFERENCE_BACKENDS
+    :param num_threads: threads used by the TFLite interpreter, defaults to all cores
+    :param artifact_dir: a directory keeping the converted TFLite flatbuffer, or the traced `tf.function`, of a
+        `.keras` file between restarts, so that they are only built for a new version of the file
+    :param version: the version of the model file, which the artifacts are named after; nothing is cached without it
+    """
+
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Invalid inference backend '{backend}'. Please choose from {INFERENCE_BACKENDS}")
+
+    if model_file.endswith(".tflite"):
+        if backend != "tflite":
+            raise ValueError(f"'{model_file}' can only be served by the tflite backend, not '{backend}'.")
+        return TFLiteBackend(num_threads=num_threads, model_path=model_file)
+
+    artifact = artifact_path(artifact_dir, model_file, version, backend) if artifact_dir and version else None
+
+    with tf.device("/CPU:0"):
+        if artifact and os.path.exists(artifact):
+            logging.getLogger(__name__).info(f"Loading '{model_file}' from the cached artifact '{artifact}'")
+            if backend == "tf_function":
+                return TFFunctionBackend(saved_model_path=artifact)
+            if backend == "tflite":
+                return TFLiteBackend(num_threads=num_threads, model_path=artifact)
+
+        model = load_model(model_file)
+
+        if backend == "tf_function":
+            tf_function_backend = TFFunctionBackend(model)
+            if artifact:
+                _write_artifact(artifact, tf_function_backend.save)
+            return tf_function_backend
+        if backend == "tflite":
+            model_content = convert_to_tflite(model)
+            if artifact and _write_artifact(artifact, lambda path: _write_bytes(path, model_content)):
+                # Memory-map the cached file like any other .tflite file, rather than keeping a copy per process
+                return TFLiteBackend(num_threads=num_threads, model_path=artifact)
+            return TFLiteBackend(model_content, num_threads)
+        return KerasBackend(model)
+
+
+def artifact_path(artifact_dir: str, model_file: str, version: str, backend: str) -> Optional[str]:
+    """
+    The path of the cached artifact of a model file for a backend, or None if the backend has none. Artifacts are
+    named after the TensorFlow version too, as they aren't guaranteed to load with another one.
+    """
+    extension = {"tf_function": "savedmodel", "tflite": "tflite"}.get(backend)
+    if extension is None:
+        return None
+
+    stem = os.path.splitext(os.path.basename(model_file))[0]
+    return os.path.join(artifact_dir, f"{stem}.{version}.tf{tf.__version__}.{extension}")
+
+
+def _write_artifact(path: str, write) -> bool:
+    """
+    Write an artifact to a temporary path and move it in place, so that processes starting together never read a
+    partial one. Returns whether the artifact is in place; failing to cache it doesn't fail the load.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        write(tmp_path)
+        os.rename(tmp_path, path)
+        return True
+    except Exception as e:
+        if os.path.exists(path):
+            # Another process wrote it first
+            return True
+        logging.getLogger(__name__).warning(f"Failed to cache the artifact '{path}': {e}")
+        return False
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_bytes(path: str, content: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def _named_outputs(outputs) -> Dict[str, tf.Tensor]:
+    if isinstance(outputs, (list, tuple)):
+        return {f"output_{i}": output for i, output in enumerate(outputs)}
+    return {"output_0": outputs}
+
+
+def _unname_outputs(outputs: Dict[str, np.ndarray], multi_output: bool) -> Any:
+    # Signature outputs come back keyed by name, put them back in the order of the model's outputs
+    ordered = [outputs[name] for name in sorted(outputs, key=lambda name: int(re.sub(r"\D", "", name) or 0))]
+    return ordered if multi_output else ordered[0]
@@ -0,0 +1,117 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, List, Tuple
+
+import numpy as np
+
+from lib.metrics import observe_inference_batch
+
+
+class InferenceScheduler:
+    """
+    Groups concurrent predictions on a model into batches, running one forward pass per batch.
+
+    It is a drop-in replacement for the model in the endpoints: `predict` takes a batch of samples and returns the
+    same as `model.predict` would for that batch, while a single worker thread owns the model.
+
+    @attr max_batch_size: the number of samples after which a batch is run without waiting any longer
+    @attr max_wait_ms: how long the first request of a batch waits for others to join it
+    """
+
+    def __init__(self, model, name: str, max_batch_size: int = 32, max_wait_ms: float = 5.0) -> None:
+        self._model = model
+        self._name = name
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000.0
+        self._queue: queue.Queue = queue.Queue()
+        self._logger = logging.getLogger(__name__)
+        self._thread = threading.Thread(target=self._run, name=f"inference-scheduler-{name}", daemon=True)
+        self._thread.start()
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    def predict(self, x: np.ndarray, **kwargs) -> Any:
+        """
+        Queue a batch of samples and block until its predictions are ready.
+
+        Keyword arguments of `model.predict` are accepted for compatibility and ignored: the scheduler picks the batch size.
+        """
+        future: Future = Future()
+        self._queue.put((np.asarray(x), future))
+        return future.result()
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        The number of predictions waiting for a batch.
+        """
+        return self._queue.qsize()
+
+    def close(self) -> None:
+        """
+        Stop the worker thread once the queued predictions are done.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            items = [item]
+            size = len(item[0])
+            deadline = time.monotonic() + self._max_wait
+
+            while size < self._max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._run_batch(items)
+                    return
+                items.append(item)
+                size += len(item[0])
+
+            self._run_batch(items)
+
+    def _run_batch(self, items: List[Tuple[np.ndarray, Future]]) -> None:
+        batch = np.concatenate([x for x, _ in items]) if len(items) > 1 else items[0][0]
+        self.logger.debug(f"Running batch of {len(batch)} samples from {len(items)} requests on model '{self._name}'")
+
+        start = time.perf_counter()
+        try:
+            predictions = self.model.predict(batch, batch_size=len(batch), verbose=0)
+            observe_inference_batch(self._name, len(batch), time.perf_counter() - start)
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        for x, future in items:
+            future.set_result(_slice_predictions(predictions, offset, offset + len(x)))
+            offset += len(x)
+
+
+def _slice_predictions(predictions, start: int, stop: int):
+    """
+    Slice the predictions of a batch, for models with a single output or with one output per tower.
+    """
+    if isinstance(predictions, (list, tuple)):
+        return [pred[start:stop] for pred in predictions]
+    return predictions[start:stop]
@@ -0,0 +1,207 @@
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from lib.sdk.models import BaseJobState
+
+
+class JobQueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue is full, so that callers back off instead of piling up.
+    """
+
+
+class PredictionJob(BaseModel):
+    """
+    A batch prediction run in the background.
+
+    @attr scenes: the scenes to predict, each being five relative paths in IMAGE_SEQUENCE order
+    @attr pid: the process running the job
+    @attr result: one result per scene, see `predict_scenes`, once the job is finished
+    @attr error: the error that made the job fail, if any
+    """
+    id: str
+    model_name: str
+    scenes: List[List[str]]
+    pid: int
+    state: BaseJobState = BaseJobState.CREATED
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[List[Dict[str, Any]]] = None
+    error: Optional[Dict[str, str]] = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "model_name": self.model_name,
+            "scenes": len(self.scenes),
+            "state": self.state.value,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class PredictionJobQueue:
+    """
+    Runs prediction jobs on a pool of worker threads, fed by a bounded queue.
+
+    If `store_dir` is set, every job is also saved there as it goes, so that the other processes sharing the directory,
+    e.g. the other gunicorn workers, can report its state and result.
+
+    @attr run: called by the workers with the model name and the scenes of a job, returning the job's result
+    @attr workers: the number of jobs run at the same time
+    @attr max_queued: the number of jobs waiting to run, after which `submit` raises JobQueueFullError
+    @attr result_ttl: seconds a finished job, and its result, is kept around to be polled
+    @attr store_dir: the directory the jobs are saved to, shared by every process that can be polled for them
+    """
+
+    def __init__(
+        self,
+        run: Callable[[str, List[List[str]]], List[Dict[str, Any]]],
+        workers: int = 2,
+        max_queued: int = 1000,
+        result_ttl: float = 3600.0,
+        store_dir: Optional[str] = None,
+    ) -> None:
+        self._run = run
+        self._result_ttl = result_ttl
+        self._store_dir = store_dir
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._jobs: Dict[str, PredictionJob] = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+        self._workers = [
+            threading.Thread(target=self._work, name=f"prediction-job-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, model_name: str, scenes: List[List[str]]) -> PredictionJob:
+        self._forget_expired_jobs()
+
+        job = PredictionJob(id=uuid.uuid4().hex, model_name=model_name, scenes=scenes, pid=os.getpid(), created_at=time.time())
+
+        with self._lock:
+            if self._queue.full():
+                raise JobQueueFullError(f"Too many queued jobs ({self._queue.maxsize}), retry later.")
+            self._jobs[job.id] = job
+            # Saved before it's queued, so that it's never overwritten by an older state
+            self._save(job)
+            self._queue.put_nowait(job.id)
+
+        self.logger.info(f"Submitted job '{job.id}': {len(scenes)} scenes for model '{model_name}'")
+        return job
+
+    def get(self, job_id: str) -> Optional[PredictionJob]:
+        """
+        A job of this process, or else one of another process sharing the store.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None or not self._store_dir:
+            return job
+
+        try:
+            with open(self._job_path(job_id)) as f:
+                job = PredictionJob.model_validate_json(f.read())
+        except (OSError, ValueError):
+            return None
+
+        # The process running the job exited before finishing it
+        if job.finished_at is None and not _is_alive(job.pid):
+            job.state = BaseJobState.FAILED
+            job.error = {
+                "error": f"Failed to make batch prediction for model '{job.model_name}'.",
+                "details": f"The process running the job, {job.pid}, exited before it finished.",
+                "error_type": "JobLostError",
+            }
+        return job
+
+    def _forget_expired_jobs(self) -> None:
+        expired_before = time.time() - self._result_ttl
+        with self._lock:
+            for job_id in [
+                job.id for job in self._jobs.values()
+                if job.finished_at is not None and job.finished_at < expired_before
+            ]:
+                del self._jobs[job_id]
+                if self._store_dir:
+                    try:
+                        os.remove(self._job_path(job_id))
+                    except FileNotFoundError:
+                        pass
+
+    def _job_path(self, job_id: str) -> str:
+        # Job ids are checked to be hex, as they come from the url
+        return os.path.join(self._store_dir, f"{int(job_id, 16):032x}.json")
+
+    def _save(self, job: PredictionJob) -> None:
+        if not self._store_dir:
+            return
+
+        # Write to a temporary file first, so that readers never see a partial job
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._store_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(job.model_dump_json())
+            os.replace(tmp_path, self._job_path(job.id))
+        except OSError as e:
+            # The other processes can't report the job, this one still can
+            self.logger.error(f"Failed to save job '{job.id}' to '{self._store_dir}': {e}")
+
+    def _work(self) -> None:
+        while True:
+            job = self.get(self._queue.get())
+
+            job.state = BaseJobState.RUNNING
+            job.started_at = time.time()
+            self._save(job)
+
+            try:
+                job.result = self._run(job.model_name, job.scenes)
+                job.state = BaseJobState.FINISHED
+
+            except Exception as e:
+                self.logger.error(f"Job '{job.id}' failed: {e}")
+                job.error = {
+                    "error": f"Failed to make batch prediction for model '{job.model_name}'.",
+                    "details": str(e),
+                    "error_type": e.__class__.__name__,
+                    "traceback": traceback.format_exc(),
+                }
+                job.state = BaseJobState.FAILED
+
+            finally:
+                job.finished_at = time.time()
+                self._save(job)
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,65 @@
+import os
+from typing import List
+from flask import request, jsonify
+from lib.jobs import JobQueueFullError, PredictionJobQueue
+from lib.sdk.models import BaseJobState
+
+
+JOB_MAX_SCENES = int(os.getenv("JOB_MAX_SCENES", "10000"))
+
+
+def submit_job_function(SUPPORTED_MODELS: List[str], job_queue: PredictionJobQueue):
+
+    data = request.json  # Expect JSON payload
+
+    # Validate inputs
+    required_keys = ['scenes', 'model_name']
+    if not data or not all(key in data for key in required_keys):
+        return jsonify({'error': f'Invalid input. JSON with keys {required_keys} is required.'}), 400
+
+    scenes = data['scenes']
+    if not isinstance(scenes, list) or not all(isinstance(scene, list) for scene in scenes):
+        return jsonify({'error': 'Invalid input. "scenes" must be a list of lists of relative paths.'}), 400
+
+    if not 0 < len(scenes) <= JOB_MAX_SCENES:
+        return jsonify({"error": f"Between 1 and {JOB_MAX_SCENES} scenes required, Received {len(scenes)}."}), 400
+
+    original_model_name = data['model_name']
+    model_name = original_model_name.strip().lower()
+    if model_name not in SUPPORTED_MODELS:
+        return jsonify({"error": f"Invalid model name '{original_model_name}'. Please choose from {SUPPORTED_MODELS}"}), 400
+
+    try:
+        job = job_queue.submit(model_name, scenes)
+    except JobQueueFullError as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': '10'}
+
+    return jsonify(job.status()), 202, {'Location': f"/jobs/{job.id}"}
+
+
+def job_status_function(job_queue: PredictionJobQueue, job_id: str):
+
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': f"Job '{job_id}' not found."}), 404
+
+    return jsonify(job.status())
+
+
+def job_result_function(job_queue: PredictionJobQueue, job_id: str):
+
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': f"Job '{job_id}' not found."}), 404
+
+    if job.state == BaseJobState.FAILED:
+        return jsonify({'job_id': job.id, 'state': job.state.value, **job.error}), 500
+
+    if job.state != BaseJobState.FINISHED:
+        return jsonify({'error': f"Job '{job_id}' is {job.state.value}, its result isn't available yet.", **job.status()}), 409
+
+    return jsonify({
+        'job_id': job.id,
+        'state': job.state.value,
+        'data': job.result,
+    })
@@ -0,0 +1,187 @@
+import contextlib
+import contextvars
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+    from prometheus_client.multiprocess import MultiProcessCollector
+except ImportError:
+    # Metrics are optional: without prometheus_client, recording is a no-op and /metrics is disabled
+    prometheus_client = None
+
+
+METRICS_ENABLED = prometheus_client is not None and os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Set under gunicorn, so that the metrics of every worker are aggregated, see the prometheus_client docs
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# The stages of a prediction: parsing the relative paths, signing and downloading the images, decoding and resizing
+# them, waiting for the model, and serializing the response
+STAGES = ("parse", "sign", "download", "decode", "inference", "serialize")
+
+# The keys of the caches' `stats()` that are sizes rather than counters
+_CACHE_SIZE_KEYS = ("entries", "files", "tensors", "bytes")
+
+_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+if METRICS_ENABLED:
+    _stage_seconds = prometheus_client.Histogram(
+        "predictor_stage_seconds", "Time spent in each stage of a prediction", ["stage"], buckets=_BUCKETS,
+    )
+    _inference_batch_seconds = prometheus_client.Histogram(
+        "predictor_inference_batch_seconds", "Time of a forward pass, per model and batch size rounded up to a power of two",
+        ["model", "batch_size"], buckets=_BUCKETS,
+    )
+    _requests = prometheus_client.Counter(
+        "predictor_requests", "Requests answered, per endpoint and status code", ["endpoint", "status"],
+    )
+    _request_seconds = prometheus_client.Histogram(
+        "predictor_request_seconds", "Time to answer a request, per endpoint", ["endpoint"], buckets=_BUCKETS,
+    )
+    _in_flight = prometheus_client.Gauge(
+        "predictor_in_flight_requests", "Requests being answered, per endpoint", ["endpoint"], multiprocess_mode="livesum",
+    )
+
+
+# The stages of the current request, when its timing breakdown was asked for, see request_timings
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("request_timings", default=None)
+_request_timings_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def request_timings() -> Iterator[Dict[str, float]]:
+    """
+    Collect the seconds spent in each stage of the current request, whether metrics are enabled or not.
+
+    Stages running on other threads are only collected if those run in a copy of the request's context, see
+    `contextvars.copy_context`; stages running concurrently, like the downloads of a scene, add up.
+    """
+    timings: Dict[str, float] = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    timings = _request_timings.get()
+    if timings is not None:
+        with _request_timings_lock:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+    if METRICS_ENABLED:
+        _stage_seconds.labels(stage).observe(seconds)
+
+
+@contextlib.contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """
+    Time a block, or a function when used as a decorator, as a stage of a prediction, see STAGES.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def observe_inference_batch(model_name: str, batch_size: int, seconds: float) -> None:
+    if METRICS_ENABLED:
+        # Rounded up to a power of two, to bound the number of series
+        _inference_batch_seconds.labels(model_name, str(1 << (batch_size - 1).bit_length())).observe(seconds)
+
+
+def request_started(endpoint: str) -> None:
+    if METRICS_ENABLED:
+        _in_flight.labels(endpoint).inc()
+
+
+def request_finished(endpoint: str, status: int, seconds: float) -> None:
+    if METRICS_ENABLED:
+        _in_flight.labels(endpoint).dec()
+        _requests.labels(endpoint, str(status)).inc()
+        _request_seconds.labels(endpoint).observe(seconds)
+
+
+class _StateCollector:
+    """
+    Reports the counters and gauges the service already keeps, read at scrape time, so that they cost nothing per
+    request. They are the ones of the process answering the scrape.
+    """
+
+    def __init__(
+        self,
+        cache_stats: Callable[[], Dict[str, Optional[Dict[str, int]]]],
+        queue_depths: Callable[[], Dict[str, int]],
+        kernel_planckster_stats: Callable[[], Dict[str, int]],
+    ) -> None:
+        self._cache_stats = cache_stats
+        self._queue_depths = queue_depths
+        self._kernel_planckster_stats = kernel_planckster_stats
+
+    def collect(self):
+        cache_events = CounterMetricFamily("predictor_cache_events", "Cache hits, misses and evictions, per cache", labels=["cache", "event"])
+        cache_size = GaugeMetricFamily("predictor_cache_size", "Entries and bytes held by a cache", labels=["cache", "unit"])
+        for cache, stats in self._cache_stats().items():
+            for key, value in (stats or {}).items():
+                if key in _CACHE_SIZE_KEYS:
+                    cache_size.add_metric([cache, key], value)
+                else:
+                    cache_events.add_metric([cache, key], value)
+        yield cache_events
+        yield cache_size
+
+        kp_errors = CounterMetricFamily("predictor_kernel_planckster_errors", "Failed calls to Kernel Planckster, and calls rejected while it's down", labels=["kind"])
+        for kind, count in self._kernel_planckster_stats().items():
+            kp_errors.add_metric([kind], count)
+        yield kp_errors
+
+        queue_depth = GaugeMetricFamily("predictor_queue_depth", "Items waiting in a queue", labels=["queue"])
+        for queue, depth in self._queue_depths().items():
+            queue_depth.add_metric([queue], depth)
+        yield queue_depth
+
+
+_state_collector: Optional[_StateCollector] = None
+
+
+def register_state_collector(
+    cache_stats: Callable[[], Dict[str, Optional[Dict[str, int]]]],
+    queue_depths: Callable[[], Dict[str, int]],
+    kernel_planckster_stats: Callable[[], Dict[str, int]],
+) -> None:
+    """
+    Report the state of the service with the metrics.
+
+    :param cache_stats: returns the `stats()` of every cache, by cache name
+    :param queue_depths: returns the depth of every queue, by queue name
+    :param kernel_planckster_stats: returns the error counters of the Kernel Planckster circuit breaker
+    """
+    global _state_collector
+    if not METRICS_ENABLED or _state_collector is not None:
+        return
+
+    _state_collector = _StateCollector(cache_stats, queue_depths, kernel_planckster_stats)
+    prometheus_client.REGISTRY.register(_state_collector)
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """
+    The metrics in the Prometheus text format, and their content type.
+    """
+    if not METRICS_ENABLED:
+        raise ValueError("Metrics are disabled, install 'prometheus_client' and set METRICS_ENABLED to enable them.")
+
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
+
+    registry = prometheus_client.CollectorRegistry()
+    MultiProcessCollector(registry)
+    if _state_collector is not None:
+        registry.register(_state_collector)
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,471 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+
+from lib.inference_backend import load_backend
+from lib.inference_scheduler import InferenceScheduler
+from lib.metrics import stage_timer
+from lib.quantization import QUANTIZATION_MODES, quantized_model_file
+
+
+MODEL_MANIFEST = "models.json"
+
+# Seconds between two checks for reloads announced by the other processes sharing `reload_dir`
+RELOAD_POLL_INTERVAL = 1.0
+
+
+class ModelSpec(BaseModel):
+    """
+    An entry of the model manifest.
+
+    @attr name: the model name clients ask for, in lower case
+    @attr file: the model file, relative to the model base path
+    @attr heads: the number of outputs of the model, one per tower
+    @attr labels: the label of every head in the response, defaults to the model name for single-head models and to
+        `<name>_tower_<i>` otherwise
+    """
+    name: str
+    file: str
+    heads: int = 1
+    labels: Optional[List[str]] = None
+
+
+def load_manifest(base_path: str) -> List[ModelSpec]:
+    """
+    Read and check the model manifest of `base_path`.
+    """
+
+    manifest_path = os.path.join(base_path, MODEL_MANIFEST)
+    if not os.path.exists(manifest_path):
+        raise ValueError(f"Model manifest '{manifest_path}' not found.")
+
+    with open(manifest_path) as f:
+        specs = [ModelSpec(**entry) for entry in json.load(f)["models"]]
+
+    for spec in specs:
+        if spec.labels and len(spec.labels) != spec.heads:
+            raise ValueError(f"Model '{spec.name}' has {spec.heads} heads but {len(spec.labels)} labels in '{manifest_path}'.")
+
+    return specs
+
+
+class ModelDigest:
+    """
+    The sha256 of a model file, recomputed only when the file's size or modification time changes.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        self._file_path = file_path
+        self._stat: Optional[Tuple[int, int]] = None
+        self._digest = ""
+
+    def get(self) -> str:
+        stat = os.stat(self._file_path)
+        if (stat.st_size, stat.st_mtime_ns) != self._stat:
+            sha256 = hashlib.sha256()
+            with open(self._file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha256.update(chunk)
+            self._stat = (stat.st_size, stat.st_mtime_ns)
+            self._digest = sha256.hexdigest()
+
+        return self._digest
+
+
+class _LoadedModel:
+    """
+    A loaded version of a model, and the number of predictions running on it.
+    """
+
+    def __init__(self, scheduler: InferenceScheduler, version: str, timings: Dict[str, float]) -> None:
+        self.scheduler = scheduler
+        self.version = version
+        self.timings = timings
+        self.in_flight = 0
+        self.retired = False
+
+
+class RegisteredModel:
+    """
+    A model of the registry, loaded on first use or when warmed, and unloaded again by `evict_if_idle`.
+
+    It is what the endpoints predict with: `predict` loads the model if needed and goes through its inference
+    scheduler. `reload` loads a new version of the model file next to the current one, warms it up and swaps it in;
+    predictions already running finish on the version they started on, which is only closed once they're done.
+
+    The version of a model is the start of the sha256 of its file.
+    """
+
+    def __init__(
+        self,
+        spec: ModelSpec,
+        file_path: str,
+        backend: str,
+        num_threads: Optional[int],
+        max_batch_size: int,
+        max_wait_ms: float,
+        warmup_batch_sizes: List[int],
+        artifact_dir: Optional[str],
+    ) -> None:
+        self._spec = spec
+        self._file_path = file_path
+        self._backend = backend
+        self._num_threads = num_threads
+        self._max_batch_size = max_batch_size
+        self._max_wait_ms = max_wait_ms
+        self._warmup_batch_sizes = warmup_batch_sizes
+        self._artifact_dir = artifact_dir
+        self._loaded: Optional[_LoadedModel] = None
+        self._lock = threading.Lock()
+        # Held while a version is being loaded, so that loads and reloads don't overlap
+        self._load_lock = threading.Lock()
+        self._digest = ModelDigest(file_path)
+        self._digest_lock = threading.Lock()
+        self._failed_version: Optional[str] = None
+        self._last_used = time.monotonic()
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    @property
+    def name(self) -> str:
+        return self._spec.name
+
+    @property
+    def labels(self) -> Optional[List[str]]:
+        return self._spec.labels
+
+    @property
+    def file_path(self) -> str:
+        return self._file_path
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded is not None
+
+    @property
+    def version(self) -> str:
+        """
+        The version predictions are currently made with, or the version of the file if the model isn't loaded.
+        """
+        loaded = self._loaded
+        return loaded.version if loaded else self._file_version()
+
+    def load(self) -> None:
+        with self._load_lock:
+            if self._loaded is None:
+                loaded = self._load_version()
+                with self._lock:
+                    self._loaded = loaded
+                    self._last_used = time.monotonic()
+
+    def predict(self, x: np.ndarray, **kwargs) -> Any:
+        return self.predict_with_version(x, **kwargs)[0]
+
+    @property
+    def queue_depth(self) -> int:
+        loaded = self._loaded
+        return loaded.scheduler.queue_depth if loaded else 0
+
+    @stage_timer("inference")
+    def predict_with_version(self, x: np.ndarray, **kwargs) -> Tuple[Any, str]:
+        """
+        Predict a batch of samples, returning the predictions and the version of the model that made them.
+        """
+        loaded = self._acquire()
+        try:
+            return loaded.scheduler.predict(x, **kwargs), loaded.version
+        finally:
+            self._release(loaded)
+
+    def reload(self) -> str:
+        """
+        Load the model file again and swap it in once warm, returning the new version. Predictions keep running on
+        the current version while the new one loads.
+        """
+        with self._load_lock:
+            new = self._load_version()
+
+            with self._lock:
+                old, self._loaded = self._loaded, new
+                self._last_used = time.monotonic()
+                close_old = self._retire(old)
+
+        if close_old:
+            old.scheduler.close()
+
+        self.logger.info(f"Swapped model '{self.name}' from version {old.version if old else None} to {new.version}")
+        return new.version
+
+    def reload_if_changed(self) -> Optional[str]:
+        """
+        Reload the model if it's loaded and its file changed since, returning the new version. A version that fails
+        to load isn't tried again until the file changes again.
+        """
+        loaded = self._loaded
+        if loaded is None:
+            return None
+
+        try:
+            version = self._file_version()
+        except OSError:
+            # The file is being replaced
+            return None
+
+        if version in (loaded.version, self._failed_version):
+            return None
+
+        try:
+            return self.reload()
+        except Exception as e:
+            self._failed_version = version
+            self.logger.error(f"Failed to reload model '{self.name}' at version {version}, keeping version {loaded.version}: {e}")
+            return None
+
+    def evict_if_idle(self, idle_timeout: float) -> bool:
+        """
+        Unload the model if it's loaded, has no prediction running, and wasn't used for `idle_timeout` seconds.
+        """
+        with self._lock:
+            loaded = self._loaded
+            if loaded is None or loaded.in_flight or time.monotonic() - self._last_used < idle_timeout:
+                return False
+
+            self._loaded = None
+            self._retire(loaded)
+
+        loaded.scheduler.close()
+        self.logger.info(f"Unloaded model '{self.name}' after {idle_timeout:.0f}s idle")
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        loaded = self._loaded
+        return {
+            "name": self.name,
+            "file": self.file_path,
+            "heads": self._spec.heads,
+            "labels": self.labels,
+            "loaded": loaded is not None,
+            "version": loaded.version if loaded else None,
+            "load_timings": loaded.timings if loaded else None,
+            "idle_seconds": round(time.monotonic() - self._last_used, 1),
+        }
+
+    def _file_version(self) -> str:
+        with self._digest_lock:
+            return self._digest.get()[:12]
+
+    def _load_version(self) -> _LoadedModel:
+        start = time.monotonic()
+        version = self._file_version()
+        backend = load_backend(self._file_path, self._backend, self._num_threads, self._artifact_dir, version)
+        if self._file_version() != version:
+            raise ValueError(f"'{self._file_path}' changed while it was being loaded.")
+        loaded_at = time.monotonic()
+
+        # Run batches of the expected sizes through the model before it takes traffic, so that tracing and kernel
+        # selection don't land on requests, and check that it has the heads of the manifest
+        for batch_size in self._warmup_batch_sizes:
+            predictions = backend.predict(np.zeros((batch_size, *backend.input_shape), dtype=np.float32))
+        heads = len(predictions) if isinstance(predictions, (list, tuple)) else 1
+        if heads != self._spec.heads:
+            raise ValueError(f"Model '{self.name}' has {heads} heads, but {self._spec.heads} in the manifest.")
+
+        # Concurrent requests share forward passes through the scheduler
+        scheduler = InferenceScheduler(backend, self.name, self._max_batch_size, self._max_wait_ms)
+        timings = {"load": round(loaded_at - start, 3), "warmup": round(time.monotonic() - loaded_at, 3)}
+        self.logger.info(
+            f"Loaded model '{self.name}' version {version} from '{self._file_path}' with the '{self._backend}' backend "
+            f"in {timings['load']:.1f}s, warmed up with batches of {self._warmup_batch_sizes} in {timings['warmup']:.1f}s"
+        )
+        return _LoadedModel(scheduler, version, timings)
+
+    def _acquire(self) -> _LoadedModel:
+        while True:
+            with self._lock:
+                if self._loaded is not None:
+                    self._loaded.in_flight += 1
+                    return self._loaded
+            self.load()
+
+    def _release(self, loaded: _LoadedModel) -> None:
+        with self._lock:
+            loaded.in_flight -= 1
+            self._last_used = time.monotonic()
+            close = loaded.retired and loaded.in_flight == 0
+
+        if close:
+            loaded.scheduler.close()
+
+    def _retire(self, loaded: Optional[_LoadedModel]) -> bool:
+        """
+        Mark a replaced version as retired, returning whether it can be closed right away. Must hold the lock.
+        """
+        if loaded is None:
+            return False
+        loaded.retired = True
+        return loaded.in_flight == 0
+
+
+class ModelRegistry:
+    """
+    The models found in the manifest of `base_path`, a `models.json` file listing one ModelSpec per model.
+
+    Only the models named in `served` are registered, so a replica can serve a subset of the manifest. Models are
+    loaded on first use unless warmed, and models idle for `idle_timeout` seconds are unloaded, `0` to keep them.
+    Every `watch_interval` seconds, loaded models whose file changed are reloaded, `0` to only reload on demand.
+
+    If `reload_dir` is set, the reloads on demand are announced there, and the ones announced by the other processes
+    sharing the directory, e.g. the other gunicorn workers, are followed, so that a reload reaches all of them.
+
+    @attr variant: `float32` for the files of the manifest, or a quantization mode to serve their quantized variants
+    @attr warmup_batch_sizes: the batch sizes run through every model once loaded, before it takes traffic
+    @attr artifact_dir: where converted or traced models are cached between restarts, see load_backend
+    @attr reload_dir: the directory reloads are announced in, shared by every process serving the models
+    """
+
+    def __init__(
+        self,
+        base_path: str,
+        served: Optional[List[str]] = None,
+        backend: str = "keras",
+        num_threads: Optional[int] = None,
+        variant: str = "float32",
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        idle_timeout: float = 0.0,
+        watch_interval: float = 0.0,
+        warmup_batch_sizes: Optional[List[int]] = None,
+        artifact_dir: Optional[str] = None,
+        reload_dir: Optional[str] = None,
+    ) -> None:
+        self._logger = logging.getLogger(__name__)
+
+        specs = load_manifest(base_path)
+
+        if served:
+            unknown = set(served) - {spec.name for spec in specs}
+            if unknown:
+                raise ValueError(f"Models {sorted(unknown)} are not in the manifest of '{base_path}'. Please choose from {[spec.name for spec in specs]}")
+            specs = [spec for spec in specs if spec.name in served]
+
+        # Quantized variants are TFLite files written next to the manifest's files by docs/examples/quantize_models.py
+        if variant != "float32":
+            if variant not in QUANTIZATION_MODES:
+                raise ValueError(f"Invalid model variant '{variant}'. Please choose from {['float32', *QUANTIZATION_MODES]}")
+            backend = "tflite"
+
+        warmup_batch_sizes = warmup_batch_sizes or [1]
+        if any(batch_size < 1 for batch_size in warmup_batch_sizes):
+            raise ValueError(f"Invalid warm-up batch sizes {warmup_batch_sizes}, they must be positive.")
+
+        self._models: Dict[str, RegisteredModel] = {}
+        for spec in specs:
+            file_path = os.path.join(base_path, spec.file)
+            if variant != "float32":
+                file_path = quantized_model_file(file_path, variant)
+            self._models[spec.name] = RegisteredModel(
+                spec, file_path, backend, num_threads, max_batch_size, max_wait_ms, warmup_batch_sizes, artifact_dir,
+            )
+
+        self._idle_timeout = idle_timeout
+        self._stop = threading.Event()
+        if idle_timeout > 0:
+            threading.Thread(target=self._evict_idle, name="model-registry-eviction", daemon=True).start()
+
+        self._watch_interval = watch_interval
+        if watch_interval > 0:
+            threading.Thread(target=self._watch, name="model-registry-watch", daemon=True).start()
+
+        self._reload_dir = reload_dir
+        if reload_dir:
+            os.makedirs(reload_dir, exist_ok=True)
+            # Only the reloads announced from now on are followed, the models are loaded from their current file
+            self._announced = {name: self._announced_version(name) for name in self._models}
+            threading.Thread(target=self._follow_reloads, name="model-registry-reloads", daemon=True).start()
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._models)
+
+    def get(self, name: str) -> RegisteredModel:
+        return self._models[name]
+
+    def reload(self, name: str) -> str:
+        """
+        Reload a model, see RegisteredModel.reload, and announce it to the processes sharing `reload_dir`.
+        """
+        version = self._models[name].reload()
+
+        if self._reload_dir:
+            # Write to a temporary file first, so that readers never see a partial version
+            fd, tmp_path = tempfile.mkstemp(dir=self._reload_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(version)
+            os.replace(tmp_path, os.path.join(self._reload_dir, name))
+
+        return version
+
+    def warm(self) -> None:
+        """
+        Load every registered model now rather than on first use.
+        """
+        for model in self._models.values():
+            model.load()
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [model.status() for model in self._models.values()]
+
+    def queue_depths(self) -> Dict[str, int]:
+        """
+        The number of predictions waiting for a batch, per model.
+        """
+        return {name: model.queue_depth for name, model in self._models.items()}
+
+    def close(self) -> None:
+        self._stop.set()
+
+    def _evict_idle(self) -> None:
+        while not self._stop.wait(min(self._idle_timeout / 2, 60.0)):
+            for model in self._models.values():
+                model.evict_if_idle(self._idle_timeout)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self._watch_interval):
+            for model in self._models.values():
+                model.reload_if_changed()
+
+    def _announced_version(self, name: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self._reload_dir, name)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _follow_reloads(self) -> None:
+        while not self._stop.wait(RELOAD_POLL_INTERVAL):
+            for name, model in self._models.items():
+                version = self._announced_version(name)
+                if version is None or version == self._announced[name]:
+                    continue
+
+                self._announced[name] = version
+                # A model that isn't loaded will load the new file on first use, and the announcing process is
+                # already on the new version
+                if model.loaded and model.version != version:
+                    self.logger.info(f"Following the reload of model '{name}' to version {version}")
+                    model.reload_if_changed()
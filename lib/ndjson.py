@@ -0,0 +1,62 @@
+import json
+import traceback
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from flask import Response, request, stream_with_context
+
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def wants_ndjson() -> bool:
+    """
+    Whether the client asked for a streamed response, with `?stream=true` or an `Accept: application/x-ndjson` header.
+    """
+    return request.args.get("stream", "").lower() == "true" or request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+def ndjson_response(
+    batches: Iterable[List[Dict[str, Any]]],
+    transform: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+    summary: Optional[Dict[str, Any]] = None,
+) -> Response:
+    """
+    Stream the results of a multi-scene prediction, one JSON line per scene as soon as its batch finishes.
+
+    The stream ends with a summary record counting the predicted and failed scenes, or with an error record if the
+    prediction fails midway.
+
+    :param batches: the results of the scenes, as yielded by iter_scene_predictions
+    :param transform: applied to every result before it's written, e.g. to add fields
+    :param summary: extra fields for the summary record
+    """
+
+    def generate():
+        predicted = failed = 0
+        try:
+            for results in batches:
+                for result in results:
+                    if "data" in result:
+                        predicted += 1
+                    else:
+                        failed += 1
+                    yield json.dumps(transform(result) if transform else result) + "\n"
+
+        except Exception as e:
+            yield json.dumps({
+                "error": "Failed to make prediction.",
+                "details": str(e),
+                "error_type": e.__class__.__name__,
+                "traceback": traceback.format_exc(),
+            }) + "\n"
+            return
+
+        yield json.dumps({
+            "summary": {
+                "scenes": predicted + failed,
+                "predicted": predicted,
+                "failed": failed,
+                **(summary or {}),
+            }
+        }) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
@@ -0,0 +1,464 @@
+import asyncio
+import contextvars
+import io
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from tensorflow.keras.preprocessing.image import load_img, img_to_array
+
+from lib.metrics import observe_stage, stage_timer
+from lib.prediction_cache import PredictionCache
+from lib.sdk.file_repository import AsyncFileRepository, FileRepository
+from lib.sdk.kernel_plackster_gateway import AsyncKernelPlancksterGateway, KernelPlancksterGateway
+from lib.sdk.models import KernelPlancksterRelativePath, KernelPlancksterSourceData, ProtocolEnum
+from lib.sdk.utils import parse_relative_path
+from lib.tensor_cache import TensorCache
+from lib.utils import predictions_to_records
+
+
+# WARNING: neither these nor the file names should contain "_" in their evalscript names
+IMAGE_SEQUENCE = ("thermal", "natural", "optical-thickness", "moisture", "chlorophyll")
+
+TARGET_SIZE = (256, 256)
+
+# Number of images of a single request downloaded at the same time, and across all requests
+KP_DOWNLOAD_FANOUT = int(os.getenv("KP_DOWNLOAD_FANOUT", "5"))
+KP_MAX_CONCURRENT_DOWNLOADS = int(os.getenv("KP_MAX_CONCURRENT_DOWNLOADS", "32"))
+
+# "memory" decodes the downloaded images straight from memory, "disk" goes through files in a local directory
+PREDICT_IMAGE_PIPELINE = os.getenv("PREDICT_IMAGE_PIPELINE", "memory")
+
+# Number of scenes of a multi-scene request loaded ahead of inference, and across all requests
+SCENE_PREFETCH = int(os.getenv("SCENE_PREFETCH", "4"))
+SCENE_MAX_CONCURRENT_LOADS = int(os.getenv("SCENE_MAX_CONCURRENT_LOADS", "16"))
+
+_download_executor = ThreadPoolExecutor(max_workers=KP_MAX_CONCURRENT_DOWNLOADS, thread_name_prefix="kp-download")
+_scene_executor = ThreadPoolExecutor(max_workers=SCENE_MAX_CONCURRENT_LOADS, thread_name_prefix="scene-load")
+
+
+class InvalidRequestError(ValueError):
+    """
+    Raised when a prediction request is invalid, answered with a 400.
+
+    @attr details: extra fields to add to the JSON error response
+    """
+
+    def __init__(self, message: str, details: Optional[Dict[str, str]] = None) -> None:
+        super().__init__(message)
+        self.details = details or {}
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"error": str(self), **self.details}
+
+
+class InvalidSceneError(InvalidRequestError):
+    """
+    Raised when the relative paths of a scene can't be used for a prediction.
+    """
+
+
+@stage_timer("parse")
+def parse_scene(relative_paths: Sequence[str]) -> List[KernelPlancksterRelativePath]:
+    """
+    Parse the relative paths of a scene, checking that they follow IMAGE_SEQUENCE.
+
+    :param relative_paths: the five relative paths of the scene, in IMAGE_SEQUENCE order
+    """
+
+    if len(relative_paths) != len(IMAGE_SEQUENCE):
+        raise InvalidSceneError(f"Exactly {len(IMAGE_SEQUENCE)} relative paths required, Received {len(relative_paths)}.")
+
+    parsed_relative_paths = []
+    for i, relative_path in enumerate(relative_paths):
+        try:
+            parsed_rp = parse_relative_path(relative_path)
+        except Exception as e:
+            raise InvalidSceneError(
+                f"Failed to parse relative path for image {i+1}, '{relative_path}'.",
+                {
+                    "details": str(e),
+                    "error_type": e.__class__.__name__,
+                    "traceback": traceback.format_exc(),
+                },
+            )
+
+        if IMAGE_SEQUENCE[i] not in parsed_rp.evalscript_name:
+            raise InvalidSceneError(f"Invalid image sequence for image {i+1}. Expected '{IMAGE_SEQUENCE[i]}' in evalscript name, got '{parsed_rp.evalscript_name}'.")
+
+        parsed_relative_paths.append(parsed_rp)
+
+    return parsed_relative_paths
+
+
+@stage_timer("decode")
+def preprocess_images(images: Sequence[Any]) -> np.ndarray:
+    """
+    Load, resize and normalize the images of a scene, stacking them along the channel axis.
+
+    :param images: the images of the scene, in IMAGE_SEQUENCE order
+    :return: a float32 array of shape (256, 256, 15)
+    """
+
+    preprocessed_images = []
+    for image in images:
+        img = load_img(image, target_size=TARGET_SIZE)
+        img_array = img_to_array(img) / 255.0  # Normalize to [0, 1]
+        preprocessed_images.append(img_array)
+
+    return np.concatenate(preprocessed_images, axis=-1)
+
+
+def _submit_bounded(tasks: Sequence[Callable[[], Any]], fanout: int) -> List[Future]:
+    """
+    Submit tasks to the shared download executor, with at most `fanout` of them running at the same time.
+    """
+
+    slots = threading.BoundedSemaphore(fanout)
+    futures = []
+    for task in tasks:
+        slots.acquire()
+        # In the request's context, so that the stages of the download are part of its timings
+        future = _download_executor.submit(contextvars.copy_context().run, task)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+
+    return futures
+
+
+def _download_image(
+    parsed_rp: KernelPlancksterRelativePath,
+    kernel_planckster_gateway: KernelPlancksterGateway,
+    file_repository: FileRepository,
+    base_dir: str,
+) -> Any:
+    """
+    Download an image, returning either an in-memory file or the path of a local file, depending on PREDICT_IMAGE_PIPELINE.
+    """
+    source_datum = KernelPlancksterSourceData(
+        name=f"{parsed_rp.image_hash}_{parsed_rp.evalscript_name}",
+        protocol=ProtocolEnum.S3,
+        relative_path=parsed_rp.to_str()
+    )
+
+    sign_seconds = 0.0
+
+    def get_signed_url() -> str:
+        nonlocal sign_seconds
+        start = time.perf_counter()
+        try:
+            return kernel_planckster_gateway.generate_signed_url_for_download(source_datum)
+        finally:
+            sign_seconds = time.perf_counter() - start
+            observe_stage("sign", sign_seconds)
+
+    start = time.perf_counter()
+    content = file_repository.cached_download_bytes(
+        relative_path=source_datum.relative_path,
+        get_signed_url=get_signed_url,
+        invalidate_signed_url=lambda: kernel_planckster_gateway.invalidate_signed_url_for_download(source_datum),
+    )
+    observe_stage("download", time.perf_counter() - start - sign_seconds)
+
+    if PREDICT_IMAGE_PIPELINE == "memory":
+        return io.BytesIO(content)
+
+    # The prefix keeps concurrent requests for the same image from writing to the same file
+    file_name = f"{uuid.uuid4().hex}_{parsed_rp.timestamp}_{parsed_rp.evalscript_name}.{parsed_rp.file_extension}"
+    local_file_name = os.path.join(base_dir, file_name)
+    with open(local_file_name, "wb") as f:
+        f.write(content)
+
+    return os.path.abspath(local_file_name)
+
+
+def load_scene(
+    parsed_relative_paths: Sequence[KernelPlancksterRelativePath],
+    kernel_planckster_gateway: KernelPlancksterGateway,
+    file_repository: FileRepository,
+    tensor_cache: Optional[TensorCache] = None,
+    base_dir: str = "images",
+) -> np.ndarray:
+    """
+    Download the images of a scene from Kernel Planckster concurrently and preprocess them.
+
+    If several images fail to download, the error of the first one in IMAGE_SEQUENCE order is raised.
+
+    :param parsed_relative_paths: the parsed relative paths of the scene, see parse_scene
+    :param tensor_cache: if the scene's tensor is found there, it's returned without downloading nor decoding anything
+    :param base_dir: the directory the images are downloaded to with the "disk" pipeline; they are removed afterwards
+    """
+
+    relative_paths = [parsed_rp.to_str() for parsed_rp in parsed_relative_paths]
+    if tensor_cache:
+        combined_images = tensor_cache.get(relative_paths)
+        if combined_images is not None:
+            return combined_images
+
+    if PREDICT_IMAGE_PIPELINE == "disk":
+        os.makedirs(base_dir, exist_ok=True)
+
+    futures = _submit_bounded(
+        [
+            lambda parsed_rp=parsed_rp: _download_image(parsed_rp, kernel_planckster_gateway, file_repository, base_dir)
+            for parsed_rp in parsed_relative_paths
+        ],
+        KP_DOWNLOAD_FANOUT,
+    )
+
+    try:
+        images = [future.result() for future in futures]
+        combined_images = preprocess_images(images)
+
+        if tensor_cache:
+            tensor_cache.put(relative_paths, combined_images)
+
+        return combined_images
+
+    finally:
+        # Cleanup images, once every download is done
+        wait(futures)
+        for future in futures:
+            if future.exception() is None and isinstance(future.result(), str) and os.path.exists(future.result()):
+                os.remove(future.result())
+
+
+async def load_scene_async(
+    parsed_relative_paths: Sequence[KernelPlancksterRelativePath],
+    kernel_planckster_gateway: AsyncKernelPlancksterGateway,
+    file_repository: AsyncFileRepository,
+    executor: Executor,
+    tensor_cache: Optional[TensorCache] = None,
+) -> np.ndarray:
+    """
+    The async counterpart of load_scene, for the ASGI service: the images are downloaded concurrently on the event
+    loop, and decoded from memory on `executor`, whatever PREDICT_IMAGE_PIPELINE.
+
+    If several images fail to download, the error of the first one in IMAGE_SEQUENCE order is raised.
+    """
+
+    relative_paths = [parsed_rp.to_str() for parsed_rp in parsed_relative_paths]
+    # The tensor cache reads and writes its memory-mapped files off the event loop
+    if tensor_cache:
+        combined_images = await asyncio.to_thread(tensor_cache.get, relative_paths)
+        if combined_images is not None:
+            return combined_images
+
+    async def download(parsed_rp: KernelPlancksterRelativePath) -> bytes:
+        source_datum = KernelPlancksterSourceData(
+            name=f"{parsed_rp.image_hash}_{parsed_rp.evalscript_name}",
+            protocol=ProtocolEnum.S3,
+            relative_path=parsed_rp.to_str()
+        )
+        sign_seconds = 0.0
+
+        async def get_signed_url() -> str:
+            nonlocal sign_seconds
+            start = time.perf_counter()
+            try:
+                return await kernel_planckster_gateway.generate_signed_url_for_download(source_datum)
+            finally:
+                sign_seconds = time.perf_counter() - start
+                observe_stage("sign", sign_seconds)
+
+        start = time.perf_counter()
+        content = await file_repository.cached_download_bytes(
+            relative_path=source_datum.relative_path,
+            get_signed_url=get_signed_url,
+            invalidate_signed_url=lambda: kernel_planckster_gateway.invalidate_signed_url_for_download(source_datum),
+        )
+        observe_stage("download", time.perf_counter() - start - sign_seconds)
+        return content
+
+    contents = await asyncio.gather(*[download(parsed_rp) for parsed_rp in parsed_relative_paths], return_exceptions=True)
+    for content in contents:
+        if isinstance(content, BaseException):
+            raise content
+
+    combined_images = await asyncio.get_running_loop().run_in_executor(
+        executor, preprocess_images, [io.BytesIO(content) for content in contents],
+    )
+
+    if tensor_cache:
+        await asyncio.to_thread(tensor_cache.put, relative_paths, combined_images)
+
+    return combined_images
+
+
+def _prepare_scene(
+    i: int,
+    relative_paths: Sequence[str],
+    model_name: str,
+    model,
+    kernel_planckster_gateway: KernelPlancksterGateway,
+    file_repository: FileRepository,
+    prediction_cache: Optional[PredictionCache],
+    tensor_cache: Optional[TensorCache],
+) -> Tuple[Dict[str, Any], Optional[List[KernelPlancksterRelativePath]], Optional[np.ndarray]]:
+    """
+    Parse and load a scene, unless its prediction is cached.
+
+    :return: the result of the scene, and its parsed relative paths and tensor if it still has to be predicted
+    """
+
+    try:
+        parsed_relative_paths = parse_scene(relative_paths)
+
+        if prediction_cache:
+            model_version = model.version
+            cached_records = prediction_cache.get(model_name, parsed_relative_paths, model_version)
+            if cached_records is not None:
+                return {"index": i, "model_version": model_version, "data": cached_records}, None, None
+
+        tensor = load_scene(parsed_relative_paths, kernel_planckster_gateway, file_repository, tensor_cache)
+        return {"index": i}, parsed_relative_paths, tensor
+
+    except InvalidSceneError as e:
+        return {"index": i, **e.to_dict()}, None, None
+
+    except Exception as e:
+        return {
+            "index": i,
+            "error": f"Failed to load scene {i+1}.",
+            "details": str(e),
+            "error_type": e.__class__.__name__,
+        }, None, None
+
+
+def iter_scene_predictions(
+    model_name: str,
+    model,
+    scenes: Sequence[Sequence[str]],
+    kernel_planckster_gateway: KernelPlancksterGateway,
+    file_repository: FileRepository,
+    prediction_cache: Optional[PredictionCache] = None,
+    tensor_cache: Optional[TensorCache] = None,
+    batch_size: Optional[int] = None,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Predict many scenes, streaming them through download, decoding and batched inference.
+
+    Up to SCENE_PREFETCH scenes are loaded ahead while the model runs, and every `batch_size` loaded scenes go
+    through a single forward pass. Scenes that fail to parse or download are reported individually and don't fail
+    the others; scenes found in the prediction cache are neither downloaded nor predicted again.
+
+    :param scenes: a list of scenes, each being five relative paths in IMAGE_SEQUENCE order
+    :param batch_size: the number of scenes per forward pass; all scenes go through a single one if not set
+    :return: an iterator over the results of the scenes, yielded in scene order as each batch finishes; every result
+        has an 'index' and either a 'data' and 'model_version' or an 'error' key
+    """
+
+    batch_size = batch_size or len(scenes)
+    pending: Deque[Future] = deque()
+    scenes_to_load = iter(enumerate(scenes))
+
+    def prefetch() -> None:
+        for i, relative_paths in scenes_to_load:
+            pending.append(_scene_executor.submit(
+                _prepare_scene, i, relative_paths, model_name, model, kernel_planckster_gateway, file_repository, prediction_cache, tensor_cache,
+            ))
+            if len(pending) >= SCENE_PREFETCH:
+                return
+
+    results: List[Dict[str, Any]] = []
+    to_predict: List[Tuple[Dict[str, Any], List[KernelPlancksterRelativePath], np.ndarray]] = []
+
+    prefetch()
+    while pending:
+        result, parsed_relative_paths, tensor = pending.popleft().result()
+        prefetch()
+
+        results.append(result)
+        if tensor is not None:
+            to_predict.append((result, parsed_relative_paths, tensor))
+
+        if len(to_predict) >= batch_size or (not pending and results):
+            if to_predict:
+                batch = np.stack([tensor for _, _, tensor in to_predict])  # (N, 256, 256, 15)
+                predictions, model_version = model.predict_with_version(batch, batch_size=len(batch))
+
+                for (result, parsed_relative_paths, _), records in zip(to_predict, predictions_to_records(model_name, predictions, model.labels)):
+                    result["model_version"] = model_version
+                    result["data"] = records
+                    if prediction_cache:
+                        prediction_cache.put(model_name, parsed_relative_paths, records, model_version)
+
+            yield results
+            results, to_predict = [], []
+
+
+def predict_scenes(
+    model_name: str,
+    model,
+    scenes: Sequence[Sequence[str]],
+    kernel_planckster_gateway: KernelPlancksterGateway,
+    file_repository: FileRepository,
+    prediction_cache: Optional[PredictionCache] = None,
+    tensor_cache: Optional[TensorCache] = None,
+    batch_size: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Predict many scenes, see iter_scene_predictions.
+
+    :param batch_size: the number of scenes per forward pass; all scenes go through a single one if not set
+    :return: one result per scene, in the same order, with either a 'data' or an 'error' key
+    """
+
+    return [
+        result
+        for results in iter_scene_predictions(
+            model_name, model, scenes, kernel_planckster_gateway, file_repository, prediction_cache, tensor_cache, batch_size,
+        )
+        for result in results
+    ]
+
+
+def discover_scenes(
+    kernel_planckster_gateway: KernelPlancksterGateway,
+    case_study_name: str,
+    tracer_id: str,
+    job_id: str,
+) -> Tuple[List[Tuple[str, List[str]]], List[Dict[str, Any]]]:
+    """
+    Find the scenes of a Kernel Planckster job, by grouping its source data by timestamp.
+
+    A timestamp makes a scene when it has exactly one image for each entry of IMAGE_SEQUENCE.
+
+    :return: the (timestamp, relative paths) of the complete scenes, sorted by timestamp, and the timestamps that
+        were skipped, with the reason why
+    """
+
+    relative_path_root = f"{case_study_name}/{tracer_id}/{job_id}/"
+    source_data = kernel_planckster_gateway.list_source_data(relative_path_root)
+
+    images_by_timestamp: Dict[str, List[KernelPlancksterRelativePath]] = defaultdict(list)
+    for source_datum in source_data:
+        try:
+            parsed_rp = parse_relative_path(source_datum.relative_path)
+        except Exception:
+            continue
+        images_by_timestamp[parsed_rp.timestamp].append(parsed_rp)
+
+    scenes = []
+    skipped = []
+    for timestamp in sorted(images_by_timestamp):
+        relative_paths = []
+        for evalscript_name in IMAGE_SEQUENCE:
+            matches = [rp for rp in images_by_timestamp[timestamp] if evalscript_name in rp.evalscript_name]
+            if len(matches) != 1:
+                skipped.append({
+                    "timestamp": timestamp,
+                    "error": f"Expected exactly one '{evalscript_name}' image, found {len(matches)}.",
+                })
+                break
+            relative_paths.append(matches[0].to_str())
+        else:
+            scenes.append((timestamp, relative_paths))
+
+    return scenes, skipped
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from lib.sdk.models import KernelPlancksterRelativePath
+
+
+Records = List[Dict[str, Any]]
+
+# Seconds during which predictions still running on a replaced model version are neither cached nor served from cache
+RETIRED_VERSION_GRACE = 60.0
+
+
+class PredictionCache:
+    """
+    Caches the prediction records of scenes, keyed on the model name, the version of the model and the identity
+    (timestamp, evalscript name and image hash) of the five images of the scene.
+
+    Entries live in an in-memory LRU tier and, if `disk_dir` is set, in an on-disk tier that outlives the process.
+    Both tiers expire entries after `ttl` seconds, and are cleared for a model when a `get` asks for a new version of
+    it; predictions made by an older version are not cached. The on-disk tier can be shared by several processes, so
+    only the entries this process wrote are removed then, and the expired ones.
+
+    @attr max_entries: the number of entries of the in-memory tier
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        ttl: float = 3600.0,
+        disk_dir: Optional[str] = None,
+    ) -> None:
+        self._current_digests: Dict[str, str] = {}
+        # When each model's previous version was replaced, so that requests that read the version just before don't
+        # switch back to it
+        self._retired_digests: Dict[str, Tuple[str, float]] = {}
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._disk_dir = disk_dir
+        self._entries: "OrderedDict[str, Tuple[float, Records]]" = OrderedDict()
+        # The keys of the on-disk entries this process wrote, by model name and digest
+        self._written_keys: Dict[Tuple[str, str], Set[str]] = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "invalidations": 0}
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+    def get(
+        self,
+        model_name: str,
+        parsed_relative_paths: Sequence[KernelPlancksterRelativePath],
+        version: str,
+    ) -> Optional[Records]:
+        """
+        :param version: the current version of the model, which the prediction is for
+        """
+        digest = self._model_digest(model_name, version)
+        key = self._key(model_name, digest, parsed_relative_paths)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry[1]
+            self._entries.pop(key, None)
+
+        entry = self._read_disk(model_name, digest, key)
+
+        with self._lock:
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            self._put_memory(key, entry)
+            return entry[1]
+
+    def put(
+        self,
+        model_name: str,
+        parsed_relative_paths: Sequence[KernelPlancksterRelativePath],
+        records: Records,
+        version: str,
+    ) -> None:
+        """
+        :param version: the version of the model that made the prediction; it's only cached if it's the current one,
+            as the model may have been reloaded while the prediction ran
+        """
+        digest = version
+        with self._lock:
+            if self._current_digests.get(model_name) != digest:
+                return
+
+        key = self._key(model_name, digest, parsed_relative_paths)
+        entry = (time.time() + self._ttl, records)
+
+        with self._lock:
+            self._put_memory(key, entry)
+
+        self._write_disk(model_name, digest, key, entry)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._written_keys.clear()
+
+        if self._disk_dir:
+            shutil.rmtree(self._disk_dir, ignore_errors=True)
+
+    def _key(self, model_name: str, digest: str, parsed_relative_paths: Sequence[KernelPlancksterRelativePath]) -> str:
+        identities = [f"{rp.timestamp}/{rp.evalscript_name}/{rp.image_hash}" for rp in parsed_relative_paths]
+        return f"{model_name}-" + hashlib.sha256(json.dumps([model_name, digest, identities]).encode()).hexdigest()
+
+    def _model_digest(self, model_name: str, version: str) -> str:
+        """
+        Make `version` the current version of the model, unless it was just replaced.
+        """
+        digest = version
+
+        with self._lock:
+            if self._is_retired(model_name, digest) or self._current_digests.get(model_name) == digest:
+                return digest
+
+            if model_name in self._current_digests:
+                self._retired_digests[model_name] = (self._current_digests[model_name], time.monotonic())
+                self.logger.info(f"Model '{model_name}' changed, invalidating its cached predictions.")
+                # Keys embed the digest, so the old entries can't be hit anymore; drop them to free memory
+                for key in [key for key in self._entries if key.startswith(f"{model_name}-")]:
+                    del self._entries[key]
+                self._stats["invalidations"] += 1
+            self._current_digests[model_name] = digest
+
+            stale_written_keys = {
+                written_digest: self._written_keys.pop((name, written_digest))
+                for name, written_digest in list(self._written_keys)
+                if name == model_name and written_digest != digest
+            }
+
+        if self._disk_dir:
+            self._remove_stale_disk_entries(model_name, digest, stale_written_keys)
+
+        return digest
+
+    def _remove_stale_disk_entries(self, model_name: str, digest: str, written_keys: Dict[str, Set[str]]) -> None:
+        """
+        Remove the on-disk entries of the other versions of a model that this process wrote, or that expired. The
+        other processes sharing the on-disk tier may still be serving one of those versions.
+
+        :param written_keys: the keys this process wrote, by digest
+        """
+        now = time.time()
+        for stale_digest in self._disk_digests(model_name) - {digest}:
+            digest_dir = os.path.join(self._disk_dir, model_name, stale_digest)
+            keys = written_keys.get(stale_digest, set())
+            try:
+                file_names = os.listdir(digest_dir)
+            except OSError:
+                continue
+
+            for file_name in file_names:
+                path = os.path.join(digest_dir, file_name)
+                try:
+                    if os.path.splitext(file_name)[0] in keys or os.path.getmtime(path) + self._ttl < now:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+            # Only removed once no process has entries left in it
+            try:
+                os.rmdir(digest_dir)
+            except OSError:
+                pass
+
+    def _is_retired(self, model_name: str, digest: str) -> bool:
+        """
+        Call with the lock held.
+        """
+        retired_digest, retired_at = self._retired_digests.get(model_name, ("", 0.0))
+        return digest == retired_digest and time.monotonic() - retired_at < RETIRED_VERSION_GRACE
+
+    def _put_memory(self, key: str, entry: Tuple[float, Records]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_digests(self, model_name: str) -> set:
+        model_dir = os.path.join(self._disk_dir, model_name)
+        return set(os.listdir(model_dir)) if os.path.isdir(model_dir) else set()
+
+    def _disk_path(self, model_name: str, digest: str, key: str) -> str:
+        return os.path.join(self._disk_dir, model_name, digest, f"{key}.json")
+
+    def _read_disk(self, model_name: str, digest: str, key: str) -> Optional[Tuple[float, Records]]:
+        if not self._disk_dir:
+            return None
+
+        path = self._disk_path(model_name, digest, key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry["expires_at"] <= time.time():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+
+        return entry["expires_at"], entry["records"]
+
+    def _write_disk(self, model_name: str, digest: str, key: str, entry: Tuple[float, Records]) -> None:
+        if not self._disk_dir:
+            return
+
+        path = self._disk_path(model_name, digest, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, so that readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"expires_at": entry[0], "records": entry[1]}, f)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._written_keys.setdefault((model_name, digest), set()).add(key)
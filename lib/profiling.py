@@ -0,0 +1,167 @@
+import contextlib
+import cProfile
+import functools
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import tensorflow as tf
+from flask import make_response, request
+
+from lib.metrics import request_timings
+
+
+PROFILE_MODES = ["cprofile", "tensorflow"]
+
+# Set to a truthy value, as a header or a query parameter, to get the timing breakdown of a request
+SERVER_TIMING_HEADER = "X-Server-Timing"
+SERVER_TIMING_PARAM = "server_timing"
+
+
+def server_timing_requested() -> bool:
+    value = request.headers.get(SERVER_TIMING_HEADER) or request.args.get(SERVER_TIMING_PARAM) or ""
+    return value.lower() in ("1", "true", "yes")
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """
+    Format the seconds spent in each stage of a request as a `Server-Timing` header, in milliseconds.
+    """
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+class RequestProfiler:
+    """
+    Profiles the next requests once armed, writing the profiles to `output_dir` for offline analysis.
+
+    In `cprofile` mode, every profiled request gets a `.prof` file of the thread answering it, to open with pstats or
+    snakeviz; a single request is profiled at a time, the others go through unprofiled. In `tensorflow` mode, a single
+    TensorFlow profiler trace spans from the first profiled request to the end of the last, to open with
+    TensorBoard; the trace is process-wide, so it also has whatever else ran meanwhile.
+
+    Being in-process, it only profiles the requests of the worker process it was armed in.
+    """
+
+    def __init__(self, output_dir: str) -> None:
+        self._output_dir = output_dir
+        self._mode = PROFILE_MODES[0]
+        self._remaining = 0
+        self._in_flight = 0
+        self._trace_dir: Optional[str] = None
+        self._written: List[str] = []
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    def arm(self, requests: int, mode: str) -> None:
+        """
+        Profile the next `requests` requests.
+
+        Raises ValueError if the arguments are invalid or a capture is in progress.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Invalid profile mode '{mode}'. Please choose from {PROFILE_MODES}")
+        if requests < 1:
+            raise ValueError(f"Invalid number of requests {requests}, it must be positive.")
+
+        with self._lock:
+            if self._remaining or self._in_flight:
+                raise ValueError(f"A capture is in progress, {self._remaining} requests to go.")
+
+            os.makedirs(self._output_dir, exist_ok=True)
+            self._mode = mode
+            self._remaining = requests
+            self._written = []
+
+        self.logger.info(f"Profiling the next {requests} requests with {mode} into '{self._output_dir}'")
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "mode": self._mode,
+                "remaining": self._remaining,
+                "in_flight": self._in_flight,
+                "output_dir": self._output_dir,
+                "written": list(self._written),
+            }
+
+    @contextlib.contextmanager
+    def profile(self, endpoint: str) -> Iterator[None]:
+        """
+        Profile the block, if armed.
+
+        :param endpoint: the name of the endpoint, part of the profile's file name
+        """
+        with self._lock:
+            capture = self._remaining > 0 and not (self._mode == "cprofile" and self._in_flight)
+            if capture:
+                self._remaining -= 1
+                self._in_flight += 1
+                if self._mode == "tensorflow" and self._trace_dir is None:
+                    trace_dir = self._path(endpoint)
+                    try:
+                        tf.profiler.experimental.start(trace_dir)
+                        self._trace_dir = trace_dir
+                    except Exception as e:
+                        # e.g. another trace is running: give up on the capture rather than fail the request
+                        self.logger.error(f"Failed to start the TensorFlow profiler, cancelling the capture: {e}")
+                        capture, self._remaining, self._in_flight = False, 0, self._in_flight - 1
+
+        if not capture:
+            yield
+            return
+
+        profiler = cProfile.Profile() if self._mode == "cprofile" else None
+        try:
+            if profiler:
+                profiler.enable()
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                path = f"{self._path(endpoint)}.prof"
+                profiler.dump_stats(path)
+
+            with self._lock:
+                self._in_flight -= 1
+                if profiler:
+                    self._written.append(path)
+                elif self._remaining == 0 and self._in_flight == 0:
+                    tf.profiler.experimental.stop()
+                    self._written.append(self._trace_dir)
+                    self._trace_dir = None
+
+    def _path(self, endpoint: str) -> str:
+        return os.path.join(self._output_dir, f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{endpoint}-{time.monotonic_ns()}")
+
+
+def instrumented(request_profiler: RequestProfiler, endpoint: str):
+    """
+    Decorate a Flask view so that it's profiled when `request_profiler` is armed, and answers with a `Server-Timing`
+    header breaking down its stages when the client asks for it.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with request_profiler.profile(endpoint):
+                if not server_timing_requested():
+                    return view(*args, **kwargs)
+
+                start = time.perf_counter()
+                with request_timings() as timings:
+                    response = make_response(view(*args, **kwargs))
+                timings["total"] = time.perf_counter() - start
+
+                response.headers["Server-Timing"] = server_timing_header(timings)
+                return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,82 @@
+import glob
+import os
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+import tensorflow as tf
+
+from lib.inference_backend import convert_to_tflite
+from lib.prediction import IMAGE_SEQUENCE, preprocess_images
+from lib.utils import predictions_to_records
+
+
+QUANTIZATION_MODES = ["float16", "int8"]
+
+
+def quantized_model_file(model_file: str, mode: str) -> str:
+    """
+    The path of the quantized variant of a model file, e.g. `Unified_model.int8.tflite` for `Unified_model.keras`.
+    """
+    return f"{os.path.splitext(model_file)[0]}.{mode}.tflite"
+
+
+def load_scene_directory(img_dir: str) -> np.ndarray:
+    """
+    Load and preprocess every scene of a directory of images named `<timestamp>_<evalscript>.png`, as a batch.
+    """
+
+    timestamps = sorted({os.path.basename(path).split("_")[0] for path in glob.glob(os.path.join(img_dir, "*.png"))})
+    if not timestamps:
+        raise ValueError(f"No scenes found in '{img_dir}'.")
+
+    return np.stack([
+        preprocess_images([os.path.join(img_dir, f"{timestamp}_{img_type}.png") for img_type in IMAGE_SEQUENCE])
+        for timestamp in timestamps
+    ])
+
+
+def quantize_model(model, mode: str, calibration_samples: np.ndarray) -> bytes:
+    """
+    Convert a Keras model to a quantized TFLite flatbuffer. Inputs and outputs stay float32, so the quantized model
+    is a drop-in replacement for the float one.
+
+    :param mode: `float16` halves the weights; `int8` quantizes weights and activations, calibrating the activation
+        ranges on `calibration_samples`
+    :param calibration_samples: a batch of preprocessed scenes representative of production inputs
+    """
+
+    if mode == "float16":
+        return convert_to_tflite(model, optimizations=[tf.lite.Optimize.DEFAULT], supported_types=[tf.float16])
+
+    if mode == "int8":
+        def representative_dataset() -> Iterator[List[np.ndarray]]:
+            for sample in calibration_samples:
+                yield [sample[np.newaxis].astype(np.float32)]
+
+        return convert_to_tflite(model, optimizations=[tf.lite.Optimize.DEFAULT], representative_dataset=representative_dataset)
+
+    raise ValueError(f"Invalid quantization mode '{mode}'. Please choose from {QUANTIZATION_MODES}")
+
+
+def accuracy_report(model_name: str, reference_predictions, predictions, labels: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Compare the predictions of a quantized model with those of the float model, per tower: the share of samples
+    with the same ON/OFF and the drift of the confidence.
+    """
+
+    reference = predictions_to_records(model_name, reference_predictions, labels)
+    quantized = predictions_to_records(model_name, predictions, labels)
+
+    report = {}
+    for tower, label in enumerate(record["label"] for record in reference[0]):
+        pairs = [(ref_sample[tower], sample[tower]) for ref_sample, sample in zip(reference, quantized)]
+        drifts = np.array([abs(ref["confidence"] - rec["confidence"]) for ref, rec in pairs])
+
+        report[label] = {
+            "samples": len(pairs),
+            "agreement": sum(ref["prediction"] == rec["prediction"] for ref, rec in pairs) / len(pairs),
+            "mean_confidence_drift": float(drifts.mean()),
+            "max_confidence_drift": float(drifts.max()),
+        }
+
+    return report
@@ -0,0 +1,189 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional, Set
+
+from pydantic import BaseModel
+
+from lib.sdk.file_repository import FileRepository, SignedUrlRejectedError
+from lib.sdk.kernel_plackster_gateway import KernelPlancksterGateway
+from lib.sdk.models import KernelPlancksterSourceData
+
+
+class BulkUploadItem(BaseModel):
+    """
+    @attr local_path: the path of the file to upload
+    @attr source_data: the source data to register the file as in Kernel Planckster
+    """
+    local_path: str
+    source_data: KernelPlancksterSourceData
+
+
+class BulkUploadFailure(BaseModel):
+    relative_path: str
+    error: str
+    attempts: int
+
+
+class BulkUploadProgress(BaseModel):
+    total: int
+    uploaded: int
+    skipped: int
+    failed: int
+
+    @property
+    def done(self) -> int:
+        return self.uploaded + self.skipped + self.failed
+
+
+class BulkUploadReport(BaseModel):
+    """
+    @attr uploaded: the relative paths uploaded and registered by this run
+    @attr skipped: the relative paths already registered, by a previous run or otherwise
+    @attr failed: the items that still failed after all their attempts
+    """
+    uploaded: List[str] = []
+    skipped: List[str] = []
+    failed: List[BulkUploadFailure] = []
+
+
+class BulkUploader:
+    """
+    Uploads many files to Kernel Planckster and registers them as source data.
+
+    Items go through signing, upload and registration on a pool of `max_workers` threads, so that the three steps of
+    different items overlap. An item that fails is retried up to `max_attempts` times with exponential backoff.
+
+    Items already registered in Kernel Planckster are skipped, so that an interrupted run can be resumed by running it
+    again. If `journal_path` is set, the relative paths of registered items are also appended to that file, which is
+    checked before asking Kernel Planckster.
+    """
+
+    def __init__(
+        self,
+        kernel_planckster_gateway: KernelPlancksterGateway,
+        file_repository: FileRepository,
+        max_workers: int = 8,
+        max_attempts: int = 3,
+        backoff: float = 1.0,
+        journal_path: Optional[str] = None,
+    ) -> None:
+        self._kernel_planckster_gateway = kernel_planckster_gateway
+        self._file_repository = file_repository
+        self._max_workers = max_workers
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._journal_path = journal_path
+        self._journal_lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    def upload(
+        self,
+        items: List[BulkUploadItem],
+        progress: Optional[Callable[[BulkUploadProgress], None]] = None,
+    ) -> BulkUploadReport:
+        """
+        Upload and register the items, returning which ones were uploaded, skipped or failed.
+
+        :param progress: called after every item with the progress of the whole run
+        """
+
+        report = BulkUploadReport()
+        status = BulkUploadProgress(total=len(items), uploaded=0, skipped=0, failed=0)
+        status_lock = threading.Lock()
+
+        registered = self._registered_relative_paths(items)
+        to_upload = []
+        for item in items:
+            if item.source_data.relative_path in registered:
+                report.skipped.append(item.source_data.relative_path)
+                status.skipped += 1
+            else:
+                to_upload.append(item)
+
+        self.logger.info(f"Uploading {len(to_upload)} files, skipping {len(report.skipped)} already registered")
+        if progress and report.skipped:
+            progress(status.model_copy())
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = {executor.submit(self._upload_item, item): item for item in to_upload}
+
+            for future in as_completed(futures):
+                item = futures[future]
+                failure = future.result()
+
+                with status_lock:
+                    if failure is None:
+                        report.uploaded.append(item.source_data.relative_path)
+                        status.uploaded += 1
+                    else:
+                        report.failed.append(failure)
+                        status.failed += 1
+                    snapshot = status.model_copy()
+
+                if progress:
+                    progress(snapshot)
+
+        return report
+
+    def _upload_item(self, item: BulkUploadItem) -> Optional[BulkUploadFailure]:
+        relative_path = item.source_data.relative_path
+
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                signed_url = self._kernel_planckster_gateway.generate_signed_url_for_upload(item.source_data)
+                self._file_repository.public_upload(signed_url=signed_url, file_path=item.local_path)
+                self._kernel_planckster_gateway.register_new_source_data(item.source_data)
+                self._journal(relative_path)
+                return None
+
+            except Exception as e:
+                if isinstance(e, SignedUrlRejectedError):
+                    # Retrying with the same cached url would fail the same way
+                    self._kernel_planckster_gateway.invalidate_signed_url_for_upload(item.source_data)
+
+                if attempt == self._max_attempts:
+                    self.logger.error(f"Failed to upload '{item.local_path}' to '{relative_path}' after {attempt} attempts: {e}")
+                    return BulkUploadFailure(relative_path=relative_path, error=str(e), attempts=attempt)
+
+                delay = self._backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                self.logger.warning(f"Failed to upload '{item.local_path}' to '{relative_path}' (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def _registered_relative_paths(self, items: List[BulkUploadItem]) -> Set[str]:
+        registered: Set[str] = set()
+        relative_paths = [item.source_data.relative_path for item in items]
+        if not relative_paths:
+            return registered
+
+        if self._journal_path and os.path.exists(self._journal_path):
+            with open(self._journal_path) as f:
+                registered.update(line.strip() for line in f if line.strip())
+
+        remaining = set(relative_paths) - registered
+        if remaining:
+            # List only under the longest prefix shared by the items, rather than the whole catalogue
+            prefix = os.path.commonprefix(sorted(remaining))
+            prefix = prefix[:prefix.rfind("/") + 1]
+            registered.update(
+                source_datum.relative_path
+                for source_datum in self._kernel_planckster_gateway.iter_source_data(prefix)
+                if source_datum.relative_path in remaining
+            )
+
+        return registered
+
+    def _journal(self, relative_path: str) -> None:
+        if not self._journal_path:
+            return
+
+        with self._journal_lock:
+            with open(self._journal_path, "a") as f:
+                f.write(f"{relative_path}\n")
@@ -1,21 +1,213 @@
+import asyncio
+import hashlib
+import io
 import logging
 import os
 import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Dict, Iterator, Optional
 
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from lib.sdk.models import KernelPlancksterSourceData, ProtocolEnum
 
 
+class ChecksumMismatchError(ValueError):
+    pass
+
+
+class StalePartialDownloadError(ValueError):
+    pass
+
+
+class SignedUrlRejectedError(ValueError):
+    """
+    Raised when the storage answers a signed url with a client error, e.g. because it was revoked or expired, so that
+    callers sign it again rather than retry with it.
+    """
+
+
+def _raise_for_status(status_code: int, text: str, action: str) -> None:
+    if 400 <= status_code < 500:
+        raise SignedUrlRejectedError(f"Failed to {action} signed url, rejected with {status_code}: {text}")
+    raise ValueError(f"Failed to {action} signed url: {text}")
+
+
+def _validator(headers) -> Optional[str]:
+    """
+    The validator of a response for an `If-Range` header: its strong ETag, or else its Last-Modified.
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def _range_headers(offset: int, validator: Optional[str]) -> Dict[str, str]:
+    """
+    The headers requesting a file from `offset`, only if it's still the one with `validator`.
+    """
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        if validator:
+            headers["If-Range"] = validator
+    return headers
+
+
+def _check_resumed(offset: int, validator: Optional[str], status_code: int, signed_url: str) -> int:
+    """
+    The bytes to skip from the response to a range request, as received already.
+
+    Raises StalePartialDownloadError if the file changed since they were.
+    """
+    if not offset or status_code == 206:
+        return 0
+    if validator:
+        raise StalePartialDownloadError(f"File at signed url changed since {validator}, the partial download is stale.")
+    # The storage ignored the range, skip what was already received
+    return offset
+
+
+class _ChunkedReader:
+    """
+    Reads a file in chunks of `chunk_size` bytes for an upload, hashing them as they're sent.
+
+    Exposes the size of the file, so that the upload is sent with a Content-Length rather than chunked encoding,
+    which signed urls don't accept.
+    """
+
+    def __init__(self, f: BinaryIO, chunk_size: int, hasher: "hashlib._Hash") -> None:
+        self._f = f
+        self._chunk_size = chunk_size
+        self._hasher = hasher
+        self._size = os.fstat(f.fileno()).st_size - f.tell()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._f.read(self._chunk_size)
+        self._hasher.update(chunk)
+        return chunk
+
+
+class ImageCache:
+    """
+    A bounded on-disk cache of downloaded files, keyed by their Kernel Planckster relative path.
+
+    Relative paths embed the image hash, so a cached file never goes stale. The least recently used files are
+    evicted once the cache grows over `max_bytes`. Files are written atomically, so concurrent readers, including
+    other processes sharing `cache_dir`, never see a partial file, and the cache is picked up again after a restart.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int) -> None:
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._logger = logging.getLogger(__name__)
+
+        # Rebuild the LRU order from the access times of the files left by a previous run
+        os.makedirs(cache_dir, exist_ok=True)
+        files = [entry for entry in os.scandir(cache_dir) if entry.is_file() and not entry.name.endswith(".tmp")]
+        files.sort(key=lambda entry: entry.stat().st_atime)
+        self._entries: "OrderedDict[str, int]" = OrderedDict((entry.name, entry.stat().st_size) for entry in files)
+        self._size = sum(self._entries.values())
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "files": len(self._entries), "bytes": self._size}
+
+    def get(self, relative_path: str) -> Optional[bytes]:
+        key = self._key(relative_path)
+
+        try:
+            with open(os.path.join(self._cache_dir, key), "rb") as f:
+                content = f.read()
+            os.utime(os.path.join(self._cache_dir, key))
+        except FileNotFoundError:
+            with self._lock:
+                self._stats["misses"] += 1
+                if key in self._entries:
+                    self._size -= self._entries.pop(key)
+            return None
+
+        with self._lock:
+            self._stats["hits"] += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return content
+
+    def put(self, relative_path: str, content: bytes) -> None:
+        key = self._key(relative_path)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, os.path.join(self._cache_dir, key))
+
+        with self._lock:
+            self._size += len(content) - self._entries.pop(key, 0)
+            self._entries[key] = len(content)
+
+            while self._size > self._max_bytes and len(self._entries) > 1:
+                evicted_key, evicted_size = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self._stats["evictions"] += 1
+                try:
+                    os.remove(os.path.join(self._cache_dir, evicted_key))
+                except FileNotFoundError:
+                    pass
+
+    def _key(self, relative_path: str) -> str:
+        return hashlib.sha256(relative_path.encode()).hexdigest()
+
+
 class FileRepository:
     def __init__(
             self,
             protocol: ProtocolEnum,
             data_dir: str = "data",  # can be used for config
+            pool_connections: int = 10,
+            pool_maxsize: int = 32,
+            timeout: float = 60.0,
+            image_cache: Optional[ImageCache] = None,
+            chunk_size: int = 1024 * 1024,
+            max_resumes: int = 3,
+            checksum_algorithm: str = "sha256",
     ) -> None:
+        """
+        :param pool_connections: number of hosts to keep a connection pool for
+        :param pool_maxsize: connections kept open per host, should match the number of concurrent transfers
+        :param timeout: seconds to wait for the storage to connect and to send data
+        :param image_cache: the cache used by `cached_download_bytes`, if any
+        :param chunk_size: bytes read from or written to the network at a time, bounding the memory of a transfer
+        :param max_resumes: times an interrupted download is resumed from where it stopped before giving up
+        :param checksum_algorithm: the hashlib algorithm of the checksums passed to the download methods
+        """
         self._protocol = protocol
         self._data_dir = data_dir
+        self._timeout = timeout
+        self._image_cache = image_cache
+        self._chunk_size = chunk_size
+        self._max_resumes = max_resumes
+        self._checksum_algorithm = checksum_algorithm
         self._logger = logging.getLogger(__name__)
 
+        self._session = requests.Session()
+        self._session.verify = False
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
     @property
     def protocol(self) -> ProtocolEnum:
         return self._protocol
@@ -23,6 +215,26 @@ class FileRepository:
     @property
     def data_dir(self) -> str:
         return self._data_dir
+
+    @property
+    def image_cache(self) -> Optional[ImageCache]:
+        return self._image_cache
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    @property
+    def chunk_size(self) -> int:
+        return self._chunk_size
+
+    @property
+    def max_resumes(self) -> int:
+        return self._max_resumes
+
+    @property
+    def checksum_algorithm(self) -> str:
+        return self._checksum_algorithm
     
     @property
     def logger(self) -> logging.Logger:
@@ -59,35 +271,377 @@ class FileRepository:
         return pfn
 
         
-    def public_upload(self, signed_url: str, file_path: str) -> None:
+    def public_upload(self, signed_url: str, file_path: str, verify_checksum: bool = False) -> None:
         """
-        Upload a file to a signed url.
+        Upload a file to a signed url, streaming it in chunks of `chunk_size` bytes.
 
         :param signed_url: The signed url to upload to.
         :param file_path: The path to the file to upload.
+        :param verify_checksum: Whether to check the MD5 of the sent bytes against the ETag returned by the storage.
         """
 
+        hasher = hashlib.md5()
         with open(file_path, "rb") as f:
-            upload_res = requests.put(signed_url, data=f, verify=False)
+            upload_res = self._session.put(
+                signed_url,
+                data=_ChunkedReader(f, self._chunk_size, hasher),
+                timeout=self._timeout,
+            )
 
         if upload_res.status_code != 200:
-            raise ValueError(f"Failed to upload file to signed url: {upload_res.text}")
+            _raise_for_status(upload_res.status_code, upload_res.text, "upload file to")
+
+        # Multipart and encrypted objects have an ETag that isn't the MD5 of their content, so it can't be checked
+        etag = upload_res.headers.get("ETag", "").strip('"')
+        if verify_checksum and len(etag) == 32 and etag != hasher.hexdigest():
+            raise ChecksumMismatchError(f"Uploaded '{file_path}' has ETag {etag}, expected MD5 {hasher.hexdigest()}.")
 
+    def iter_download(
+        self,
+        signed_url: str,
+        offset: int = 0,
+        validator: Optional[str] = None,
+        on_validator: Optional[Callable[[Optional[str]], Any]] = None,
+    ) -> Iterator[bytes]:
+        """
+        Stream a file from a signed url in chunks of `chunk_size` bytes.
+
+        If the connection drops midway, the download is resumed from the last received byte with a range request,
+        up to `max_resumes` times. The range is conditioned on the file being unchanged with `If-Range`: if it
+        changed, a StalePartialDownloadError is raised.
+
+        :param signed_url: The signed url to download from.
+        :param offset: The byte to start from, to resume a partial download.
+        :param validator: The ETag or Last-Modified of the file the partial download was received from.
+        :param on_validator: Called with the ETag or Last-Modified of the file, or None, before its first chunk.
+        """
+
+        resumes = 0
+        while True:
+            headers = _range_headers(offset, validator)
+            try:
+                with self._session.get(signed_url, headers=headers, stream=True, timeout=self._timeout) as download_res:
+                    # The partial download was already complete
+                    if offset and download_res.status_code == 416:
+                        return
+
+                    if download_res.status_code not in (200, 206):
+                        _raise_for_status(download_res.status_code, download_res.text, "download file from")
+
+                    skip = _check_resumed(offset, validator, download_res.status_code, signed_url)
+                    if not offset or not validator:
+                        validator = _validator(download_res.headers)
+                        if on_validator:
+                            on_validator(validator)
+
+                    for chunk in download_res.iter_content(chunk_size=self._chunk_size):
+                        if skip:
+                            skipped = min(skip, len(chunk))
+                            chunk, skip = chunk[skipped:], skip - skipped
+                            if not chunk:
+                                continue
+                        offset += len(chunk)
+                        yield chunk
+                return
 
-    def public_download(self, signed_url: str, file_path: str) -> str:
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+                if resumes >= self._max_resumes:
+                    raise
+                resumes += 1
+                self.logger.warning(f"Download interrupted after {offset} bytes, resuming ({resumes}/{self._max_resumes}): {e}")
+
+    def public_download_into(
+        self,
+        signed_url: str,
+        write: Callable[[bytes], Any],
+        expected_checksum: Optional[str] = None,
+    ) -> int:
         """
-        Download a file from a signed url.
+        Stream a file from a signed url into a sink, e.g. the `write` of an in-memory buffer or the `feed` of a
+        decoder, without holding the whole file in memory. Returns the number of bytes written.
+
+        :param signed_url: The signed url to download from.
+        :param write: Called with every chunk, in order.
+        :param expected_checksum: The hex digest the content should have, checked as it's streamed.
+        """
+
+        hasher = hashlib.new(self._checksum_algorithm) if expected_checksum else None
+        size = 0
+
+        for chunk in self.iter_download(signed_url):
+            if hasher:
+                hasher.update(chunk)
+            write(chunk)
+            size += len(chunk)
+
+        self.verify_checksum(hasher, expected_checksum, signed_url)
+
+        return size
+
+    def public_download_bytes(self, signed_url: str, expected_checksum: Optional[str] = None) -> bytes:
+        """
+        Download a file from a signed url into memory.
+
+        :param signed_url: The signed url to download from.
+        :param expected_checksum: The hex digest the content should have, checked as it's streamed.
+        """
+
+        buffer = io.BytesIO()
+        self.public_download_into(signed_url, buffer.write, expected_checksum)
+
+        return buffer.getvalue()
+
+    def cached_download_bytes(
+        self,
+        relative_path: str,
+        get_signed_url: Callable[[], str],
+        invalidate_signed_url: Optional[Callable[[], Any]] = None,
+    ) -> bytes:
+        """
+        Download a file into memory, going through the image cache if there is one.
+
+        :param relative_path: The relative path of the file in Kernel Planckster, used as cache key.
+        :param get_signed_url: Called to sign the url to download from, only on a cache miss.
+        :param invalidate_signed_url: Called to forget a cached signed url the storage rejected, before it's signed
+            again for a second and last try.
+        """
+
+        if self.image_cache:
+            content = self.image_cache.get(relative_path)
+            if content is not None:
+                return content
+
+        try:
+            content = self.public_download_bytes(get_signed_url())
+        except SignedUrlRejectedError as e:
+            if not invalidate_signed_url:
+                raise
+            self.logger.warning(f"Signing '{relative_path}' again: {e}")
+            invalidate_signed_url()
+            content = self.public_download_bytes(get_signed_url())
+
+        if self.image_cache:
+            self.image_cache.put(relative_path, content)
+
+        return content
+
+    def public_download(self, signed_url: str, file_path: str, expected_checksum: Optional[str] = None) -> str:
+        """
+        Download a file from a signed url, streaming it to disk.
+
+        The file is written to `<file_path>.part` and only moved to `file_path` once complete. If a `.part` file is
+        left by an interrupted download, the download resumes from its end, provided the file is unchanged since:
+        its ETag or Last-Modified is kept in `<file_path>.part.validator`. Otherwise, it starts over.
 
         :param signed_url: The signed url to download from.
         :param file_path: The path to save the downloaded file.
+        :param expected_checksum: The hex digest the content should have, checked as it's streamed.
         """
 
-        download_res = requests.get(signed_url, verify=False)
+        part_path = f"{file_path}.part"
+        validator_path = f"{part_path}.validator"
+
+        validator = None
+        if os.path.exists(part_path) and os.path.exists(validator_path):
+            with open(validator_path) as f:
+                validator = f.read() or None
 
-        if download_res.status_code != 200:
-            raise ValueError(f"Failed to download file from signed url: {download_res.text}")
+        def save_validator(new_validator: Optional[str]) -> None:
+            if new_validator:
+                with open(validator_path, "w") as f:
+                    f.write(new_validator)
+            elif os.path.exists(validator_path):
+                os.remove(validator_path)
 
-        with open(file_path, "wb") as f:
-            f.write(download_res.content)
+        try:
+            hasher = self._download_part(signed_url, part_path, validator, save_validator, expected_checksum)
+        except StalePartialDownloadError as e:
+            self.logger.warning(f"Restarting the download of '{file_path}': {e}")
+            hasher = self._download_part(signed_url, part_path, None, save_validator, expected_checksum)
+
+        try:
+            self.verify_checksum(hasher, expected_checksum, signed_url)
+        except ChecksumMismatchError:
+            os.remove(part_path)
+            save_validator(None)
+            raise
+
+        os.replace(part_path, file_path)
+        save_validator(None)
 
         return file_path
+
+    def _download_part(
+        self,
+        signed_url: str,
+        part_path: str,
+        validator: Optional[str],
+        on_validator: Callable[[Optional[str]], Any],
+        expected_checksum: Optional[str],
+    ) -> "Optional[hashlib._Hash]":
+        """
+        Download a file to `part_path`, resuming it if there's a `validator` for its content, or else from scratch.
+        Returns the hasher of the whole content, if there's a checksum to verify.
+        """
+
+        # Without a validator, the partial download can't be known to still match the file
+        offset = os.path.getsize(part_path) if validator and os.path.exists(part_path) else 0
+        hasher = hashlib.new(self._checksum_algorithm) if expected_checksum else None
+
+        if hasher and offset:
+            with open(part_path, "rb") as f:
+                for chunk in iter(lambda: f.read(self._chunk_size), b""):
+                    hasher.update(chunk)
+
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in self.iter_download(signed_url, offset, validator, on_validator):
+                if hasher:
+                    hasher.update(chunk)
+                f.write(chunk)
+
+        return hasher
+
+    def verify_checksum(self, hasher: "Optional[hashlib._Hash]", expected_checksum: Optional[str], signed_url: str) -> None:
+        """
+        Check the digest of a streamed download, raising ChecksumMismatchError if it isn't the expected one.
+
+        :param hasher: The hasher the content was fed to, None if there's no checksum to verify.
+        """
+        if hasher and hasher.hexdigest() != expected_checksum.lower():
+            raise ChecksumMismatchError(
+                f"Downloaded file from signed url has {self._checksum_algorithm} {hasher.hexdigest()}, expected {expected_checksum}."
+            )
+
+    def close(self) -> None:
+        """
+        Close the pooled connections to the storage.
+        """
+        self._session.close()
+
+
+class AsyncFileRepository:
+    """
+    Downloads like a FileRepository, over an async client, for the ASGI service.
+
+    It goes through the image cache of `file_repository`, and uses its timeout, chunk size, resumes and checksum
+    algorithm. At most `max_concurrent_downloads` downloads run at the same time, the others wait for a slot on the
+    event loop.
+    """
+
+    def __init__(self, file_repository: FileRepository, max_concurrent_downloads: int = 256) -> None:
+        self._file_repository = file_repository
+        self._logger = logging.getLogger(__name__)
+        self._slots = asyncio.Semaphore(max_concurrent_downloads)
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_concurrent_downloads, max_keepalive_connections=max_concurrent_downloads),
+            timeout=file_repository.timeout,
+            verify=False,
+        )
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    async def iter_download(self, signed_url: str, offset: int = 0) -> AsyncIterator[bytes]:
+        """
+        Stream a file from a signed url in chunks, resuming it where it stopped if the connection drops, see
+        FileRepository.iter_download.
+        """
+
+        max_resumes = self._file_repository.max_resumes
+        validator = None
+        resumes = 0
+        while True:
+            headers = _range_headers(offset, validator)
+            try:
+                async with self._client.stream("GET", signed_url, headers=headers) as download_res:
+                    # The partial download was already complete
+                    if offset and download_res.status_code == 416:
+                        return
+
+                    if download_res.status_code not in (200, 206):
+                        await download_res.aread()
+                        _raise_for_status(download_res.status_code, download_res.text, "download file from")
+
+                    skip = _check_resumed(offset, validator, download_res.status_code, signed_url)
+                    if not offset or not validator:
+                        validator = _validator(download_res.headers)
+
+                    async for chunk in download_res.aiter_bytes(chunk_size=self._file_repository.chunk_size):
+                        if skip:
+                            skipped = min(skip, len(chunk))
+                            chunk, skip = chunk[skipped:], skip - skipped
+                            if not chunk:
+                                continue
+                        offset += len(chunk)
+                        yield chunk
+                return
+
+            except httpx.TransportError as e:
+                if resumes >= max_resumes:
+                    raise
+                resumes += 1
+                self.logger.warning(f"Download interrupted after {offset} bytes, resuming ({resumes}/{max_resumes}): {e}")
+
+    async def public_download_bytes(self, signed_url: str, expected_checksum: Optional[str] = None) -> bytes:
+        """
+        Download a file from a signed url into memory.
+
+        :param signed_url: The signed url to download from.
+        :param expected_checksum: The hex digest the content should have, checked as it's streamed.
+        """
+
+        hasher = hashlib.new(self._file_repository.checksum_algorithm) if expected_checksum else None
+        buffer = io.BytesIO()
+
+        async with self._slots:
+            async for chunk in self.iter_download(signed_url):
+                if hasher:
+                    hasher.update(chunk)
+                buffer.write(chunk)
+
+        self._file_repository.verify_checksum(hasher, expected_checksum, signed_url)
+
+        return buffer.getvalue()
+
+    async def cached_download_bytes(
+        self,
+        relative_path: str,
+        get_signed_url: Callable[[], Awaitable[str]],
+        invalidate_signed_url: Optional[Callable[[], Any]] = None,
+    ) -> bytes:
+        """
+        Download a file into memory, going through the image cache if there is one. The cache is on disk, so it's
+        read and written off the event loop.
+
+        :param relative_path: The relative path of the file in Kernel Planckster, used as cache key.
+        :param get_signed_url: Awaited to sign the url to download from, only on a cache miss.
+        :param invalidate_signed_url: Called to forget a cached signed url the storage rejected, see
+            FileRepository.cached_download_bytes.
+        """
+
+        image_cache = self._file_repository.image_cache
+        if image_cache:
+            content = await asyncio.to_thread(image_cache.get, relative_path)
+            if content is not None:
+                return content
+
+        try:
+            content = await self.public_download_bytes(await get_signed_url())
+        except SignedUrlRejectedError as e:
+            if not invalidate_signed_url:
+                raise
+            self.logger.warning(f"Signing '{relative_path}' again: {e}")
+            invalidate_signed_url()
+            content = await self.public_download_bytes(await get_signed_url())
+
+        if image_cache:
+            await asyncio.to_thread(image_cache.put, relative_path, content)
+
+        return content
+
+    async def aclose(self) -> None:
+        """
+        Close the pooled connections to the storage. The file repository is left open.
+        """
+        await self._client.aclose()
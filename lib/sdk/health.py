@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from enum import Enum
+from typing import Callable, Dict, Optional
+
+
+class CircuitState(Enum):
+    """
+    The state of the circuit breaker in front of Kernel Planckster.
+
+    Attributes:
+    - CLOSED: Kernel Planckster is alive, calls go through
+    - OPEN: Kernel Planckster is down, calls fail fast
+    - HALF_OPEN: the recovery timeout is over, a single trial call goes through
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class KernelPlancksterUnavailableError(Exception):
+    """
+    Raised instead of calling Kernel Planckster while the circuit breaker is open.
+    """
+
+
+class KernelPlancksterHealth:
+    """
+    Tracks the liveness of Kernel Planckster from the outcome of real calls, and optionally from a background probe.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls fail fast for `recovery_timeout`
+    seconds. Then a single trial call is let through: its success closes the circuit, its failure opens it again.
+
+    @attr probe: the function used by the background probe, returning whether Kernel Planckster is alive
+    @attr probe_interval: seconds between two probes; the probe is disabled if not set
+    """
+
+    def __init__(
+        self,
+        probe: Callable[[], bool],
+        failure_threshold: int = 3,
+        recovery_timeout: float = 30.0,
+        probe_interval: Optional[float] = None,
+    ) -> None:
+        self._probe = probe
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout = recovery_timeout
+        self._probe_interval = probe_interval
+        self._state = CircuitState.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._stats = {"failures": 0, "rejected": 0}
+        self._lock = threading.Lock()
+        self._stop_probe = threading.Event()
+        self._probe_thread: Optional[threading.Thread] = None
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    @property
+    def state(self) -> CircuitState:
+        return self._state
+
+    @property
+    def is_alive(self) -> bool:
+        return self._state == CircuitState.CLOSED
+
+    def stats(self) -> Dict[str, int]:
+        """
+        The number of failed calls, and of calls rejected while the circuit was open.
+        """
+        return dict(self._stats)
+
+    def before_call(self) -> None:
+        """
+        Check that a call to Kernel Planckster can go through, raising KernelPlancksterUnavailableError otherwise.
+        """
+        with self._lock:
+            if self._state == CircuitState.CLOSED:
+                return
+
+            if self._state == CircuitState.OPEN:
+                remaining = self._opened_at + self._recovery_timeout - time.monotonic()
+                if remaining > 0:
+                    self._stats["rejected"] += 1
+                    raise KernelPlancksterUnavailableError(f"Kernel Planckster is unavailable, retrying in {remaining:.1f}s.")
+                self._state = CircuitState.HALF_OPEN
+                self._trial_in_flight = False
+
+            if self._trial_in_flight:
+                self._stats["rejected"] += 1
+                raise KernelPlancksterUnavailableError("Kernel Planckster is unavailable, a trial call is in flight.")
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != CircuitState.CLOSED:
+                self.logger.info("Kernel Planckster is alive again, closing the circuit.")
+            self._state = CircuitState.CLOSED
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """
+        End a call that neither succeeded nor failed, e.g. one that was cancelled, so that the next call can be the
+        trial call if the circuit is half open.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            self._stats["failures"] += 1
+
+            if self._state == CircuitState.HALF_OPEN or (
+                self._state == CircuitState.CLOSED and self._consecutive_failures >= self._failure_threshold
+            ):
+                self.logger.error(f"Kernel Planckster is down after {self._consecutive_failures} consecutive failures, opening the circuit for {self._recovery_timeout}s.")
+                self._state = CircuitState.OPEN
+                self._opened_at = time.monotonic()
+
+    def start_probe(self) -> None:
+        """
+        Start probing Kernel Planckster in the background every `probe_interval` seconds, if set.
+        """
+        if not self._probe_interval or self._probe_thread is not None:
+            return
+
+        self._stop_probe.clear()
+        self._probe_thread = threading.Thread(target=self._run_probe, name="kp-health-probe", daemon=True)
+        self._probe_thread.start()
+
+    def stop_probe(self) -> None:
+        if self._probe_thread is None:
+            return
+
+        self._stop_probe.set()
+        self._probe_thread.join()
+        self._probe_thread = None
+
+    def _run_probe(self) -> None:
+        while not self._stop_probe.wait(self._probe_interval):
+            try:
+                alive = self._probe()
+            except Exception as error:
+                self.logger.warning(f"Kernel Planckster probe failed: {error}")
+                alive = False
+
+            if alive:
+                self.record_success()
+            else:
+                self.record_failure()
@@ -1,19 +1,76 @@
 import logging
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import httpx
 
+from lib.sdk.health import KernelPlancksterHealth
 from lib.sdk.models import KernelPlancksterSourceData
+from lib.sdk.signed_url_cache import SignedUrlCache, SignedUrlKey
 
 
 
 class KernelPlancksterGateway:
-    def __init__(self, host: str, port: str, auth_token: str, scheme: str) -> None:
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        auth_token: str,
+        scheme: str,
+        failure_threshold: int = 3,
+        recovery_timeout: float = 30.0,
+        probe_interval: Optional[float] = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        timeout: float = 5.0,
+        http2: bool = False,
+        listing_cache_ttl: float = 60.0,
+        signed_url_cache: Optional[SignedUrlCache] = None,
+        bulk_sign_concurrency: int = 8,
+    ) -> None:
+        """
+        :param failure_threshold: consecutive failed calls after which calls to Kernel Planckster fail fast
+        :param recovery_timeout: seconds to fail fast for, before trying Kernel Planckster again
+        :param probe_interval: seconds between two background pings of Kernel Planckster; disabled if not set
+        :param max_connections: size of the connection pool to Kernel Planckster
+        :param max_keepalive_connections: idle connections kept open in the pool
+        :param keepalive_expiry: seconds after which an idle connection is closed
+        :param timeout: seconds to wait for Kernel Planckster to connect and to answer
+        :param http2: whether to use HTTP/2, which needs the 'h2' package
+        :param listing_cache_ttl: seconds a source data listing is reused for the same prefix, or a longer one
+        :param signed_url_cache: the cache of the signed urls generated for uploads and downloads, if any
+        :param bulk_sign_concurrency: the number of signing requests sent at the same time when signing in bulk
+        """
         self._host = host
         self._port = port
         self._client_id = 1  # NOTE: this should match the default client for this project
         self._auth_token = auth_token
         self._scheme = scheme
         self._logger = logging.getLogger(__name__)
+        self._client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=timeout,
+            http2=http2,
+        )
+        self._health = KernelPlancksterHealth(
+            probe=self._ping,
+            failure_threshold=failure_threshold,
+            recovery_timeout=recovery_timeout,
+            probe_interval=probe_interval,
+        )
+        self._health.start_probe()
+        self._listing_cache_ttl = listing_cache_ttl
+        self._listing_cache: Dict[str, Tuple[float, List[KernelPlancksterSourceData]]] = {}
+        self._listing_cache_lock = threading.Lock()
+        self._signed_url_cache = signed_url_cache
+        self._bulk_sign_concurrency = bulk_sign_concurrency
 
     @property
     def url(self) -> str:
@@ -23,16 +80,84 @@ class KernelPlancksterGateway:
     def logger(self) -> logging.Logger:
         return self._logger
 
-    def ping(self) -> bool:
+    @property
+    def health(self) -> KernelPlancksterHealth:
+        return self._health
+
+    @property
+    def signed_url_cache(self) -> Optional[SignedUrlCache]:
+        return self._signed_url_cache
+
+    def _ping(self) -> bool:
         self.logger.info(f"Pinging Kernel Plankster Gateway at {self.url}")
-        res = httpx.get(f"{self.url}/ping")
+        res = self._client.get(f"{self.url}/ping")
         self.logger.info(f"Ping response: {res.text}")
         return res.status_code == 200
 
+    def ping(self) -> bool:
+        """
+        Ping Kernel Planckster, bypassing the circuit breaker but updating it with the outcome.
+        """
+        try:
+            alive = self._ping()
+        except httpx.TransportError:
+            self.health.record_failure()
+            raise
+
+        if alive:
+            self.health.record_success()
+        else:
+            self.health.record_failure()
+        return alive
+
+    def _request(self, method: str, url: str, stream: bool = False, **kwargs) -> httpx.Response:
+        """
+        Send a request to Kernel Planckster through the circuit breaker.
+
+        Transport errors and 5xx responses count as failures, any other response as a sign of life.
+
+        :param stream: if set, the body isn't read, and the caller has to close the response
+        """
+        return self._send(self._client.build_request(method, url, **kwargs), stream=stream)
+
+    def _send(self, request: httpx.Request, stream: bool = False) -> httpx.Response:
+        self.health.before_call()
+
+        try:
+            res = self._client.send(request, stream=stream)
+        except httpx.TransportError:
+            self.health.record_failure()
+            raise
+        except BaseException:
+            # Says nothing about Kernel Planckster, but must not leave a trial call in flight forever
+            self.health.release_trial()
+            raise
+
+        if res.status_code >= 500:
+            self.health.record_failure()
+        else:
+            self.health.record_success()
+        return res
+
+    def close(self) -> None:
+        """
+        Stop the background probe and close the pooled connections to Kernel Planckster.
+        """
+        self.health.stop_probe()
+        self._client.close()
+
+    def __enter__(self) -> "KernelPlancksterGateway":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
     def generate_signed_url_for_upload(self, source_data: KernelPlancksterSourceData) -> str:
-        if not self.ping():
-            self.logger.error(f"Failed to ping Kernel Plankster Gateway at {self.url}")
-            raise Exception("Failed to ping Kernel Plankster Gateway")
+        key = (source_data.protocol.value, source_data.relative_path, "upload")
+        if self.signed_url_cache:
+            signed_url = self.signed_url_cache.get(key)
+            if signed_url:
+                return signed_url
 
         self.logger.info(f"Generating signed url for {source_data.relative_path}")
 
@@ -48,7 +173,8 @@ class KernelPlancksterGateway:
             "x-auth-token": self._auth_token,
             }
 
-        res = httpx.get(
+        res = self._request(
+            "GET",
             url=endpoint,
             params=params,
             headers=headers,
@@ -65,8 +191,25 @@ class KernelPlancksterGateway:
         if not signed_url:
             raise ValueError(f"Failed to generate signed url. Signed URL not found in response. Dumping raw response:\n{res_json}")
 
+        if self.signed_url_cache:
+            self.signed_url_cache.put(key, signed_url, res_json)
+
         return signed_url
-        
+
+    def invalidate_signed_url_for_upload(self, source_data: KernelPlancksterSourceData) -> None:
+        """
+        Forget the cached signed url for uploading a source data, after the storage rejected it.
+        """
+        if self.signed_url_cache:
+            self.signed_url_cache.invalidate((source_data.protocol.value, source_data.relative_path, "upload"))
+
+    def invalidate_signed_url_for_download(self, source_data: KernelPlancksterSourceData) -> None:
+        """
+        Forget the cached signed url for downloading a source data, after the storage rejected it.
+        """
+        if self.signed_url_cache:
+            self.signed_url_cache.invalidate((source_data.protocol.value, source_data.relative_path, "download"))
+
     def register_new_source_data(self, source_data: KernelPlancksterSourceData) -> dict[str, str]:
         """
         Registers new source data with Kernel Plankster Gateway.
@@ -75,10 +218,6 @@ class KernelPlancksterGateway:
         - source_data: KernelPlancksterSourceData
 
         """
-        if not self.ping():
-            self.logger.error(f"Failed to ping Kernel Plankster Gateway at {self.url}")
-            raise Exception("Failed to ping Kernel Plankster Gateway")
-
         self.logger.info(f"Registering new data with Kernel Plankster Gateway at {self.url}")
 
         params = {
@@ -94,7 +233,8 @@ class KernelPlancksterGateway:
             "x-auth-token": self._auth_token,
             }
 
-        res = httpx.post(
+        res = self._request(
+            "POST",
             url=endpoint,
             params=params,
             headers=headers,
@@ -123,12 +263,26 @@ class KernelPlancksterGateway:
         return kp_source_data
 
     def list_source_data(self, relative_path_root: str) -> list[KernelPlancksterSourceData]:
-        if not self.ping():
-            self.logger.error(f"Failed to ping Kernel Plankster Gateway at {self.url}")
-            raise Exception("Failed to ping Kernel Plankster Gateway")
+        return list(self.iter_source_data(relative_path_root))
+
+    def iter_source_data(self, relative_path_root: str, page_size: int = 1000) -> Iterator[KernelPlancksterSourceData]:
+        """
+        Lazily list the source data whose relative path starts with `relative_path_root`.
 
-        self.logger.info(f"Listing source with Kernel Plankster Gateway at {self.url}")
+        The prefix and the page are sent to Kernel Planckster. Versions of Kernel Planckster that ignore either send
+        back the whole list, or pages of it, which are then parsed incrementally and filtered here. A complete listing is cached for
+        `listing_cache_ttl` seconds, and serves later listings of the same prefix or of a longer one.
 
+        Args:
+        - relative_path_root: the prefix of the relative paths to list
+        - page_size: the number of source data asked for per request
+        """
+        cached = self._cached_listing(relative_path_root)
+        if cached is not None:
+            yield from cached
+            return
+
+        self.logger.info(f"Listing source data under '{relative_path_root}' with Kernel Plankster Gateway at {self.url}")
 
         endpoint = f"{self.url}/client/{self._client_id}/source"
 
@@ -137,43 +291,85 @@ class KernelPlancksterGateway:
             "x-auth-token": self._auth_token,
             }
 
-        res = httpx.get(
-            url=endpoint,
-            headers=headers,
-        )
+        listing: List[KernelPlancksterSourceData] = []
+        # Every relative path listed, under the root or not, in case Kernel Planckster doesn't filter on the prefix
+        listed = set()
+        offset = 0
 
-        self.logger.info(f"List source data response: {res.text}")
-        if res.status_code != 200:
-            raise ValueError(
-                f"Failed to list source data with Kernel Plankster Gateway: {res.text}"
-            )
-
-        kp_source_data = res.json()
-
-        if not kp_source_data:
-            raise ValueError(f"Failed to list source data. Source Data not returned. Dumping raw response:\n{res.json()}")
+        while True:
+            params = {
+                "relative_path_prefix": relative_path_root,
+                "limit": page_size,
+                "offset": offset,
+            }
 
-        if not kp_source_data['status']:
-            raise ValueError(f"Failed to list source data. Source Data status not returned. Dumping raw response:\n{res.json()}")
-        
-        kp_source_data = kp_source_data.get("source_data_list")
-        output: list[KernelPlancksterSourceData] = [
-            KernelPlancksterSourceData(
-                name=x.get("name"),
-                protocol=x.get("protocol"),
-                relative_path=x.get("relative_path"),
-            ) for x in kp_source_data
-            if x.get("relative_path").startswith(relative_path_root)
-        ]
-        return output
+            res = self._request("GET", url=endpoint, params=params, headers=headers, stream=True)
+            try:
+                if res.status_code != 200:
+                    res.read()
+                    raise ValueError(
+                        f"Failed to list source data with Kernel Plankster Gateway: {res.text}"
+                    )
+
+                page_items = 0
+                new_items = 0
+                for x in _iter_json_list_items(res.iter_text(), "source_data_list"):
+                    page_items += 1
+                    relative_path = x.get("relative_path")
+                    if relative_path in listed:
+                        continue
+                    listed.add(relative_path)
+                    new_items += 1
+                    if not relative_path.startswith(relative_path_root):
+                        continue
+
+                    source_datum = KernelPlancksterSourceData(
+                        name=x.get("name"),
+                        protocol=x.get("protocol"),
+                        relative_path=relative_path,
+                    )
+                    listing.append(source_datum)
+                    yield source_datum
+            finally:
+                res.close()
+
+            self.logger.info(f"Listed {page_items} source data at offset {offset}, {len(listing)} under '{relative_path_root}' so far")
+
+            # Stop at the last page, or when Kernel Planckster ignores the pagination: it sent everything at once, or
+            # the same page again
+            if page_items != page_size or not new_items:
+                break
+            offset += page_items
+
+        with self._listing_cache_lock:
+            self._listing_cache[relative_path_root] = (time.monotonic() + self._listing_cache_ttl, listing)
+
+    def _cached_listing(self, relative_path_root: str) -> Optional[List[KernelPlancksterSourceData]]:
+        now = time.monotonic()
+        with self._listing_cache_lock:
+            for prefix, (expires_at, listing) in list(self._listing_cache.items()):
+                if expires_at <= now:
+                    del self._listing_cache[prefix]
+                elif relative_path_root.startswith(prefix):
+                    return [x for x in listing if x.relative_path.startswith(relative_path_root)]
+        return None
 
     def generate_signed_url_for_download(self, source_data: KernelPlancksterSourceData) -> str:
-        if not self.ping():
-            self.logger.error(f"Failed to ping Kernel Plankster Gateway at {self.url}")
-            raise Exception("Failed to ping Kernel Plankster Gateway")
+        key = (source_data.protocol.value, source_data.relative_path, "download")
+        if self.signed_url_cache:
+            signed_url = self.signed_url_cache.get(key)
+            if signed_url:
+                return signed_url
 
         self.logger.info(f"Generating signed url for {source_data.relative_path}")
 
+        res = self._send(self.download_credentials_request(source_data))
+        return self.read_signed_url(res, key)
+
+    def download_credentials_request(self, source_data: KernelPlancksterSourceData) -> httpx.Request:
+        """
+        The request signing a source data for download, for clients sending it on their own, e.g. asynchronously.
+        """
         endpoint = f"{self.url}/client/{self._client_id}/download-credentials"
 
         params = {
@@ -186,12 +382,12 @@ class KernelPlancksterGateway:
             "x-auth-token": self._auth_token,
             }
 
-        res = httpx.get(
-            url=endpoint,
-            params=params,
-            headers=headers,
-        )
+        return self._client.build_request("GET", endpoint, params=params, headers=headers)
 
+    def read_signed_url(self, res: httpx.Response, key: SignedUrlKey) -> str:
+        """
+        The signed url of the response to a credentials request, cached under `key`.
+        """
         self.logger.info(f"Generate signed url response: {res.text}")
         if res.status_code != 200:
             raise ValueError(f"Failed to generate signed url: {res.text}")
@@ -203,5 +399,158 @@ class KernelPlancksterGateway:
         if not signed_url:
             raise ValueError(f"Failed to generate signed url. Signed URL not found in response. Dumping raw response:\n{res_json}")
 
+        if self.signed_url_cache:
+            self.signed_url_cache.put(key, signed_url, res_json)
+
         return signed_url
-        
\ No newline at end of file
+
+    def generate_signed_urls_for_download(self, source_data: List[KernelPlancksterSourceData]) -> List[str]:
+        """
+        Sign many source data for download at once, in the same order.
+
+        Cached urls are reused, the others are signed with up to `bulk_sign_concurrency` requests at the same time.
+        """
+        return self._generate_signed_urls(self.generate_signed_url_for_download, source_data)
+
+    def generate_signed_urls_for_upload(self, source_data: List[KernelPlancksterSourceData]) -> List[str]:
+        """
+        Sign many source data for upload at once, in the same order, see generate_signed_urls_for_download.
+        """
+        return self._generate_signed_urls(self.generate_signed_url_for_upload, source_data)
+
+    def _generate_signed_urls(self, sign, source_data: List[KernelPlancksterSourceData]) -> List[str]:
+        if len(source_data) <= 1:
+            return [sign(x) for x in source_data]
+
+        with ThreadPoolExecutor(max_workers=min(self._bulk_sign_concurrency, len(source_data))) as executor:
+            return list(executor.map(sign, source_data))
+
+
+class AsyncKernelPlancksterGateway:
+    """
+    Signs downloads like a KernelPlancksterGateway, over an async client, for the ASGI service.
+
+    It goes through the circuit breaker and the signed url cache of `gateway`, so that both see the same state of
+    Kernel Planckster, and sends the same requests.
+    """
+
+    def __init__(
+        self,
+        gateway: KernelPlancksterGateway,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+    ) -> None:
+        """
+        :param max_connections: size of the connection pool to Kernel Planckster
+        :param max_keepalive_connections: idle connections kept open in the pool
+        :param keepalive_expiry: seconds after which an idle connection is closed
+        :param http2: whether to use HTTP/2, which needs the 'h2' package
+        """
+        self._gateway = gateway
+        self._logger = logging.getLogger(__name__)
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            http2=http2,
+        )
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    @property
+    def health(self) -> KernelPlancksterHealth:
+        return self._gateway.health
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        """
+        Send a request to Kernel Planckster through the circuit breaker, see KernelPlancksterGateway._request.
+        """
+        self.health.before_call()
+
+        try:
+            res = await self._client.send(request)
+        except httpx.TransportError:
+            self.health.record_failure()
+            raise
+        except BaseException:
+            # e.g. the request was cancelled: it says nothing about Kernel Planckster, but must not leave a trial
+            # call in flight forever
+            self.health.release_trial()
+            raise
+
+        if res.status_code >= 500:
+            self.health.record_failure()
+        else:
+            self.health.record_success()
+        return res
+
+    async def generate_signed_url_for_download(self, source_data: KernelPlancksterSourceData) -> str:
+        key = (source_data.protocol.value, source_data.relative_path, "download")
+        if self._gateway.signed_url_cache:
+            signed_url = self._gateway.signed_url_cache.get(key)
+            if signed_url:
+                return signed_url
+
+        self.logger.info(f"Generating signed url for {source_data.relative_path}")
+
+        # The request carries the timeout of the gateway's client
+        res = await self._send(self._gateway.download_credentials_request(source_data))
+        return self._gateway.read_signed_url(res, key)
+
+    def invalidate_signed_url_for_download(self, source_data: KernelPlancksterSourceData) -> None:
+        """
+        Forget the cached signed url for downloading a source data, see KernelPlancksterGateway.
+        """
+        self._gateway.invalidate_signed_url_for_download(source_data)
+
+    async def aclose(self) -> None:
+        """
+        Close the pooled connections to Kernel Planckster. The gateway is left open.
+        """
+        await self._client.aclose()
+
+
+def _iter_json_list_items(chunks: Iterable[str], key: str) -> Iterator[dict]:
+    """
+    Incrementally parse the items of the list under `key` in a JSON document, as its text chunks come in.
+
+    Raises ValueError if the document has no such list.
+    """
+    decoder = json.JSONDecoder()
+    marker = f'"{key}"'
+    buffer = ""
+    in_list = False
+
+    for chunk in chunks:
+        buffer += chunk
+
+        if not in_list:
+            position = buffer.find(marker)
+            if position == -1:
+                buffer = buffer[-len(marker):]
+                continue
+            bracket = buffer.find("[", position + len(marker))
+            if bracket == -1:
+                buffer = buffer[position:]
+                continue
+            buffer = buffer[bracket + 1:]
+            in_list = True
+
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,")
+            if buffer.startswith("]"):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                break
+            yield item
+            buffer = buffer[end:]
+
+    raise ValueError(f"Failed to list source data. '{key}' not found in the response.")
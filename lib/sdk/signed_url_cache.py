@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+SignedUrlKey = Tuple[str, str, str]  # (protocol, relative_path, direction)
+
+
+def signed_url_expires_at(signed_url: str, response: Optional[Dict[str, Any]] = None) -> Optional[float]:
+    """
+    Find when a signed url expires, as a unix timestamp, from the url itself or the response that carried it.
+
+    Understands S3 SigV4 (`X-Amz-Date` + `X-Amz-Expires`) and SigV2 (`Expires`) urls, and `expires_at` or
+    `expiration` fields in the response, either as unix timestamps or ISO 8601 dates.
+    """
+
+    for field in ("expires_at", "expiration"):
+        value = (response or {}).get(field)
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str):
+            try:
+                return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+            except ValueError:
+                pass
+
+    query = {key.lower(): values[0] for key, values in parse_qs(urlparse(signed_url).query).items()}
+
+    if "x-amz-date" in query and "x-amz-expires" in query:
+        try:
+            signed_at = datetime.strptime(query["x-amz-date"], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            return signed_at.timestamp() + int(query["x-amz-expires"])
+        except ValueError:
+            return None
+
+    if "expires" in query:
+        try:
+            return float(query["expires"])
+        except ValueError:
+            return None
+
+    return None
+
+
+class SignedUrlCache:
+    """
+    An LRU cache of signed urls, keyed by (protocol, relative path, direction).
+
+    A url is reused until `safety_margin` seconds before it expires, so that callers have time to use it.
+    Urls whose expiry can't be found are kept for `default_ttl` seconds.
+    """
+
+    def __init__(self, max_entries: int = 10000, safety_margin: float = 60.0, default_ttl: float = 300.0) -> None:
+        self._max_entries = max_entries
+        self._safety_margin = safety_margin
+        self._default_ttl = default_ttl
+        self._entries: "OrderedDict[SignedUrlKey, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+    def get(self, key: SignedUrlKey) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                self._entries.pop(key, None)
+                self._stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def invalidate(self, key: SignedUrlKey) -> None:
+        """
+        Forget a signed url that the storage rejected, e.g. revoked or expired early, so that it's signed again.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def put(self, key: SignedUrlKey, signed_url: str, response: Optional[Dict[str, Any]] = None) -> None:
+        expires_at = signed_url_expires_at(signed_url, response)
+        if expires_at is None:
+            reuse_until = time.time() + self._default_ttl
+        else:
+            reuse_until = expires_at - self._safety_margin
+
+        if reuse_until <= time.time():
+            return
+
+        with self._lock:
+            self._entries[key] = (reuse_until, signed_url)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
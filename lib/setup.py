@@ -2,9 +2,10 @@ from logging import Logger
 import os
 from typing import Tuple
 
-from lib.sdk.file_repository import FileRepository
-from lib.sdk.kernel_plackster_gateway import KernelPlancksterGateway
+from lib.sdk.file_repository import AsyncFileRepository, FileRepository, ImageCache
+from lib.sdk.kernel_plackster_gateway import AsyncKernelPlancksterGateway, KernelPlancksterGateway
 from lib.sdk.models import ProtocolEnum
+from lib.sdk.signed_url_cache import SignedUrlCache
 
 
 def _setup_kernel_planckster(
@@ -20,11 +21,26 @@ def _setup_kernel_planckster(
         logger.info(f"Setting up Kernel Planckster Gateway.")
 
         # Setup the Kernel Planckster Gateway
+        probe_interval = float(os.getenv("KP_PROBE_INTERVAL", "0"))
+        signed_url_cache_max_entries = int(os.getenv("KP_SIGNED_URL_CACHE_MAX_ENTRIES", "10000"))
+        signed_url_cache = SignedUrlCache(
+            max_entries=signed_url_cache_max_entries,
+            safety_margin=float(os.getenv("KP_SIGNED_URL_SAFETY_MARGIN", "60")),
+        ) if signed_url_cache_max_entries > 0 else None
         kernel_planckster = KernelPlancksterGateway(
             host=kernel_planckster_host,
             port=kernel_planckster_port,
             auth_token=kernel_planckster_auth_token,
             scheme=kernel_planckster_scheme,
+            failure_threshold=int(os.getenv("KP_FAILURE_THRESHOLD", "3")),
+            recovery_timeout=float(os.getenv("KP_RECOVERY_TIMEOUT", "30")),
+            probe_interval=probe_interval or None,
+            max_connections=int(os.getenv("KP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("KP_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            timeout=float(os.getenv("KP_TIMEOUT", "5")),
+            http2=os.getenv("KP_HTTP2", "false").lower() == "true",
+            listing_cache_ttl=float(os.getenv("KP_LISTING_CACHE_TTL", "60")),
+            signed_url_cache=signed_url_cache,
         )
         kernel_planckster.ping()
         logger.info(f"Kernel Planckster Gateway setup successfully.")
@@ -46,8 +62,19 @@ def _setup_file_repository(
     try:
         logger.info(f"Setting up the File Repository.")
 
+        image_cache_dir = os.getenv("IMAGE_CACHE_DIR")
+        image_cache = ImageCache(
+            cache_dir=image_cache_dir,
+            max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(2 * 1024**3))),
+        ) if image_cache_dir else None
+
         file_repository = FileRepository(
             protocol=storage_protocol,
+            pool_maxsize=int(os.getenv("STORAGE_POOL_MAXSIZE", "32")),
+            timeout=float(os.getenv("STORAGE_TIMEOUT", "60")),
+            image_cache=image_cache,
+            chunk_size=int(os.getenv("STORAGE_CHUNK_SIZE", str(1024**2))),
+            max_resumes=int(os.getenv("STORAGE_MAX_RESUMES", "3")),
         )
 
         logger.info(f"File Repository setup successfully.")
@@ -93,3 +120,33 @@ def setup(
     except Exception as error:
         logger.error(f"Unable to setup. Error:\n{error}")
         raise error
+
+
+def setup_async(
+    logger: Logger,
+    kernel_planckster: KernelPlancksterGateway,
+    file_repository: FileRepository,
+) -> Tuple[AsyncKernelPlancksterGateway, AsyncFileRepository]:
+    """
+    Setup the async counterparts of the Kernel Planckster Gateway and the file repository, for the ASGI service.
+    """
+
+    try:
+        logger.info(f"Setting up the async Kernel Planckster Gateway and File Repository.")
+
+        async_kernel_planckster = AsyncKernelPlancksterGateway(
+            gateway=kernel_planckster,
+            max_connections=int(os.getenv("KP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("KP_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            http2=os.getenv("KP_HTTP2", "false").lower() == "true",
+        )
+        async_file_repository = AsyncFileRepository(
+            file_repository=file_repository,
+            max_concurrent_downloads=int(os.getenv("ASGI_MAX_CONCURRENT_DOWNLOADS", "256")),
+        )
+
+        return async_kernel_planckster, async_file_repository
+
+    except Exception as error:
+        logger.error(f"Unable to setup the async clients. Error:\n{error}")
+        raise error
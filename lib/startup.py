@@ -0,0 +1,49 @@
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class StartupTimer:
+    """
+    Times the phases of the service's startup, to log where the time goes before it's ready.
+
+    Every phase starts where the previous one ended, the first one at `start`.
+    """
+
+    def __init__(self, start: Optional[float] = None) -> None:
+        """
+        :param start: the `time.monotonic()` the startup began at, defaults to now
+        """
+        self._start = start if start is not None else time.monotonic()
+        self._last = self._start
+        self._phases: List[Tuple[str, float, Dict[str, float]]] = []
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self) -> logging.Logger:
+        return self._logger
+
+    @property
+    def total(self) -> float:
+        return self._last - self._start
+
+    def lap(self, phase: str, details: Optional[Dict[str, float]] = None) -> None:
+        """
+        End a phase.
+
+        :param details: the seconds spent in the steps of the phase, logged with it
+        """
+        now = time.monotonic()
+        self._phases.append((phase, now - self._last, details or {}))
+        self._last = now
+
+    def timings(self) -> Dict[str, float]:
+        return {phase: round(seconds, 3) for phase, seconds, _ in self._phases}
+
+    def log(self) -> None:
+        breakdown = []
+        for phase, seconds, details in self._phases:
+            steps = ", ".join(f"{step} {step_seconds:.2f}s" for step, step_seconds in details.items())
+            breakdown.append(f"{phase} {seconds:.2f}s" + (f" ({steps})" if steps else ""))
+
+        self.logger.info(f"Started in {self.total:.2f}s: {', '.join(breakdown)}")
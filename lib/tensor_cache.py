@@ -0,0 +1,86 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+
+class TensorCache:
+    """
+    Caches the preprocessed (256, 256, 15) float32 tensors of scenes, keyed by the five relative paths of the scene.
+
+    The least recently used tensors are evicted once the cached tensors take more than `max_bytes`.
+    If `mmap_dir` is set, tensors are saved as `.npy` files and memory-mapped instead of held on the heap: the page
+    cache backs them, they are shared between processes using the same directory and outlive restarts.
+    """
+
+    def __init__(self, max_bytes: int, mmap_dir: Optional[str] = None) -> None:
+        self._max_bytes = max_bytes
+        self._mmap_dir = mmap_dir
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+        if mmap_dir:
+            os.makedirs(mmap_dir, exist_ok=True)
+            files = [entry for entry in os.scandir(mmap_dir) if entry.name.endswith(".npy")]
+            files.sort(key=lambda entry: entry.stat().st_atime)
+            for entry in files:
+                self._add(entry.name[:-len(".npy")], np.load(entry.path, mmap_mode="r"))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "tensors": len(self._entries), "bytes": self._size}
+
+    def get(self, relative_paths: Sequence[str]) -> Optional[np.ndarray]:
+        key = self._key(relative_paths)
+
+        with self._lock:
+            tensor = self._entries.get(key)
+            if tensor is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return tensor
+
+    def put(self, relative_paths: Sequence[str], tensor: np.ndarray) -> None:
+        key = self._key(relative_paths)
+        tensor = tensor.astype(np.float32, copy=False)
+
+        if self._mmap_dir:
+            # Save to a temporary file first, so that other processes never map a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self._mmap_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, tensor)
+            os.replace(tmp_path, self._path(key))
+            tensor = np.load(self._path(key), mmap_mode="r")
+
+        with self._lock:
+            self._add(key, tensor)
+
+    def _add(self, key: str, tensor: np.ndarray) -> None:
+        if key in self._entries:
+            self._size -= self._entries.pop(key).nbytes
+        self._entries[key] = tensor
+        self._size += tensor.nbytes
+
+        while self._size > self._max_bytes and len(self._entries) > 1:
+            evicted_key, evicted_tensor = self._entries.popitem(last=False)
+            self._size -= evicted_tensor.nbytes
+            self._stats["evictions"] += 1
+            if self._mmap_dir:
+                try:
+                    os.remove(self._path(evicted_key))
+                except FileNotFoundError:
+                    pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._mmap_dir, f"{key}.npy")
+
+    def _key(self, relative_paths: Sequence[str]) -> str:
+        return hashlib.sha256("\n".join(relative_paths).encode()).hexdigest()
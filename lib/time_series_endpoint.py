@@ -0,0 +1,86 @@
+import os
+import traceback
+from typing import Optional
+from flask import request, jsonify
+from lib.ndjson import ndjson_response, wants_ndjson
+from lib.prediction import discover_scenes, iter_scene_predictions
+from lib.model_registry import ModelRegistry
+from lib.prediction_cache import PredictionCache
+from lib.sdk.file_repository import FileRepository
+from lib.sdk.kernel_plackster_gateway import KernelPlancksterGateway
+from lib.tensor_cache import TensorCache
+
+
+TIME_SERIES_BATCH_SIZE = int(os.getenv("TIME_SERIES_BATCH_SIZE", "32"))
+
+
+def time_series_predict_function(
+    model_registry: ModelRegistry,
+    kernel_planckster_gateway: KernelPlancksterGateway,
+    file_repository: FileRepository,
+    prediction_cache: Optional[PredictionCache] = None,
+    tensor_cache: Optional[TensorCache] = None,
+    ):
+
+    # Log the incoming request
+    print("Received request:", request.json)
+
+    data = request.json  # Expect JSON payload
+
+    # Validate inputs
+    required_keys = ['case_study_name', 'tracer_id', 'job_id', 'model_name']
+    if not data or not all(key in data for key in required_keys):
+        return jsonify({'error': f'Invalid input. JSON with keys {required_keys} is required.'}), 400
+
+    SUPPORTED_MODELS = model_registry.names
+    original_model_name = data['model_name']
+    model_name = original_model_name.strip().lower()
+    if model_name not in SUPPORTED_MODELS:
+        return jsonify({"error": f"Invalid model name '{original_model_name}'. Please choose from {SUPPORTED_MODELS}"}), 400
+
+    model = model_registry.get(model_name)
+
+    try:
+        scenes, skipped = discover_scenes(
+            kernel_planckster_gateway,
+            str(data['case_study_name']),
+            str(data['tracer_id']),
+            str(data['job_id']),
+        )
+
+        batches = iter_scene_predictions(
+            model_name,
+            model,
+            [relative_paths for _, relative_paths in scenes],
+            kernel_planckster_gateway,
+            file_repository,
+            prediction_cache,
+            tensor_cache,
+            batch_size=TIME_SERIES_BATCH_SIZE,
+        )
+
+        if wants_ndjson():
+            return ndjson_response(
+                batches,
+                transform=lambda result: {'timestamp': scenes[result['index']][0], **result},
+                summary={'skipped': skipped},
+            )
+
+        results = [
+            {'timestamp': scenes[result['index']][0], **result}
+            for batch_results in batches
+            for result in batch_results
+        ]
+
+        return jsonify({
+            'data': results,
+            'skipped': skipped,
+        })
+
+    except Exception as e:
+        return jsonify({
+            "error": f"Failed to make time series prediction for model '{model_name}'.",
+            "details": str(e),
+            "error_type": e.__class__.__name__,
+            "traceback": traceback.format_exc(),
+        }), 500
@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import Any, Dict, List, Literal, Optional
 
 
 def probability_to_prediction(probability: int) -> Literal["ON", "OFF"]:
@@ -7,3 +7,33 @@ def probability_to_prediction(probability: int) -> Literal["ON", "OFF"]:
 def probability_to_confidence(probability: int) -> float:
     return probability if probability > 0.5 else 1 - probability
 
+def predictions_to_records(model_name: str, predictions, labels: Optional[List[str]] = None) -> List[List[Dict[str, Any]]]:
+    """
+    Turn the output of `model.predict` into one list of records per sample of the batch.
+
+    Single-output models are labelled with the model name, multi-output models get one record per tower, unless
+    `labels` gives the label of every output.
+    """
+    if isinstance(predictions, (list, tuple)):
+        towers = [pred.tolist() for pred in predictions]
+        default_labels = [f"{model_name}_tower_{i+1}" for i in range(len(towers))]
+    else:
+        towers = [predictions.tolist()]
+        default_labels = [model_name]
+
+    if labels is None:
+        labels = default_labels
+    elif len(labels) != len(towers):
+        raise ValueError(f"Model '{model_name}' has {len(towers)} outputs, but {len(labels)} labels: {labels}")
+
+    return [
+        [
+            {
+                'label': label,
+                'prediction': probability_to_prediction(tower[sample][0]),
+                'confidence': probability_to_confidence(tower[sample][0]),
+            }
+            for label, tower in zip(labels, towers)
+        ]
+        for sample in range(len(towers[0]))
+    ]